@@ -1,6 +1,9 @@
 --
 -- PostgreSQL database dump
 --
+-- Baseline schema: later schema changes are applied by oneadif/migrate.py
+-- from migrations directory, on databases created from this dump too
+--
 
 -- Dumped from database version 9.6.17
 -- Dumped by pg_dump version 9.6.17
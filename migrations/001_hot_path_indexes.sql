@@ -0,0 +1,30 @@
+--
+-- Indexes for uploads/accounts joins filtered by accounts.login
+-- (uploads list, upload cancel, uploads list delete).
+-- accounts (login, elog) unique index backs accounts upsert
+-- (on conflict (login, elog))
+--
+
+--
+-- Concurrent select-then-insert account saves could leave several rows
+-- for one (login, elog) pair: keep the latest one (it holds the last saved
+-- login_data), move the uploads of the others to it and drop them
+-- so the unique index can be built.
+--
+
+CREATE TEMPORARY TABLE accounts_dups ON COMMIT DROP AS
+    SELECT account_id, max(account_id) OVER (PARTITION BY login, elog) AS keep_id
+    FROM public.accounts;
+
+UPDATE public.uploads SET account_id = accounts_dups.keep_id
+    FROM accounts_dups
+    WHERE uploads.account_id = accounts_dups.account_id
+        AND accounts_dups.account_id <> accounts_dups.keep_id;
+
+DELETE FROM public.accounts USING accounts_dups
+    WHERE accounts.account_id = accounts_dups.account_id
+        AND accounts_dups.account_id <> accounts_dups.keep_id;
+
+CREATE UNIQUE INDEX IF NOT EXISTS accounts_login_elog_key ON public.accounts USING btree (login, elog);
+
+CREATE INDEX IF NOT EXISTS uploads_account_id_idx ON public.uploads USING btree (account_id);
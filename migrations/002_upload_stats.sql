@@ -0,0 +1,10 @@
+--
+-- QSO statistics of uploaded file computed by api before the upload
+-- (adif.stats)
+--
+
+ALTER TABLE public.uploads ADD COLUMN IF NOT EXISTS qso_count integer;
+ALTER TABLE public.uploads ADD COLUMN IF NOT EXISTS qso_date_from date;
+ALTER TABLE public.uploads ADD COLUMN IF NOT EXISTS qso_date_to date;
+ALTER TABLE public.uploads ADD COLUMN IF NOT EXISTS bands jsonb;
+ALTER TABLE public.uploads ADD COLUMN IF NOT EXISTS modes jsonb;
@@ -0,0 +1,12 @@
+--
+-- Fingerprints (adif.fingerprint) of qsos uploaded successfully to the account,
+-- uploads send only qsos which are not here yet
+--
+
+CREATE TABLE IF NOT EXISTS public.qso_fingerprints (
+    account_id integer NOT NULL REFERENCES public.accounts(account_id) ON DELETE CASCADE,
+    fp bigint NOT NULL,
+    CONSTRAINT qso_fingerprints_pkey PRIMARY KEY (account_id, fp)
+);
+
+GRANT SELECT,INSERT,DELETE ON TABLE public.qso_fingerprints TO "www-group";
@@ -0,0 +1,19 @@
+--
+-- Resumable uploads: file and params of upload are kept to resume it,
+-- parts of the file acknowledged by the elog are logged in upload_parts
+-- (their qsos fingerprints are stored in qso_fingerprints)
+--
+
+ALTER TABLE public.uploads ADD COLUMN IF NOT EXISTS file_ref character varying(64);
+ALTER TABLE public.uploads ADD COLUMN IF NOT EXISTS file_name character varying(256);
+ALTER TABLE public.uploads ADD COLUMN IF NOT EXISTS params jsonb;
+
+CREATE TABLE IF NOT EXISTS public.upload_parts (
+    upload_id integer NOT NULL REFERENCES public.uploads(upload_id) ON DELETE CASCADE,
+    part integer NOT NULL,
+    qso_count integer NOT NULL,
+    acked timestamp without time zone DEFAULT now(),
+    CONSTRAINT upload_parts_pkey PRIMARY KEY (upload_id, part)
+);
+
+GRANT SELECT,INSERT,DELETE ON TABLE public.upload_parts TO "www-group";
@@ -0,0 +1,26 @@
+--
+-- Registry of the content-addressed file store: stats of stored files
+-- are cached, files referenced by running uploads are not evicted,
+-- other files are evicted in least recently used order
+--
+
+CREATE TABLE IF NOT EXISTS public.files (
+    file_hash character varying(64) NOT NULL,
+    size bigint NOT NULL,
+    refs integer NOT NULL DEFAULT 0,
+    last_used timestamp without time zone NOT NULL DEFAULT now(),
+    stats jsonb,
+    CONSTRAINT files_pkey PRIMARY KEY (file_hash)
+);
+
+CREATE INDEX IF NOT EXISTS files_last_used_idx ON public.files USING btree (last_used);
+
+-- files stored before the registry (their size is unknown)
+INSERT INTO public.files (file_hash, size)
+SELECT DISTINCT file_ref, 0 FROM public.uploads WHERE file_ref IS NOT NULL
+ON CONFLICT DO NOTHING;
+
+ALTER TABLE public.uploads ADD CONSTRAINT uploads_file_ref_fkey
+    FOREIGN KEY (file_ref) REFERENCES public.files(file_hash) ON DELETE SET NULL;
+
+GRANT SELECT,INSERT,UPDATE,DELETE ON TABLE public.files TO "www-group";
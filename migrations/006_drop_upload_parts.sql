@@ -0,0 +1,6 @@
+--
+-- Log of acknowledged upload parts is not used: resumed uploads skip
+-- the qsos stored in qso_fingerprints
+--
+
+DROP TABLE IF EXISTS public.upload_parts;
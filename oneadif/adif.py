@@ -0,0 +1,160 @@
+#!/usr/bin/python3
+#coding=utf-8
+"""incremental parser of ADIF (adi) files
+works on any bytes-like object (bytes, memoryview, mmap) without copying
+the file; records are yielded one by one, only requested fields are decoded"""
+import array
+import hashlib
+import re
+from datetime import date
+
+#text between fields followed by the next tag
+TAG_RE = re.compile(rb'[^<]*<([A-Za-z0-9_]+)(?::(\d+)(?::[A-Za-z])?)?>')
+TAG_START_RE = re.compile(rb'<')
+EOH_RE = re.compile(rb'<[Ee][Oo][Hh]>')
+
+class AdifException(Exception):
+    """Malformed ADIF file"""
+    pass
+
+def data_start(buf):
+    """returns position of the first record: file starting with '<'
+    has no header, otherwise header ends with <EOH>"""
+    if buf[:1] == b'<':
+        return 0
+    eoh = EOH_RE.search(buf)
+    if not eoh:
+        raise AdifException('header is not terminated with <EOH>')
+    return eoh.end()
+
+def records(buf, fields=None, spans=False):
+    """yields records of adi file as dicts {FIELD_NAME: value}
+    if fields (set of upper case names) is set other fields are skipped
+    without decoding; if spans is set yields (record, start, end) where
+    buf[start:end] is the record including its <EOR>;
+    raises AdifException on malformed data"""
+    pos = data_start(buf)
+    size = len(buf)
+    if fields is not None:
+        fields = {field.encode() for field in fields}
+    record = {}
+    #record can be empty when all its fields are skipped
+    in_record = False
+    start = None
+    match_tag = TAG_RE.match
+    while True:
+        tag = match_tag(buf, pos)
+        if not tag:
+            if TAG_START_RE.search(buf, pos):
+                raise AdifException('bad tag after position ' + str(pos))
+            break
+        name, length = tag.groups()
+        name = name.upper()
+        pos = tag.end()
+        if length is None:
+            if name == b'EOR':
+                if in_record:
+                    yield (record, start, pos) if spans else record
+                record = {}
+                in_record = False
+            elif name != b'EOH':
+                raise AdifException('field ' + name.decode() + ' at position ' +\
+                    str(tag.start(1) - 1) + ' has no length')
+            continue
+        length = int(length)
+        if pos + length > size:
+            raise AdifException('field ' + name.decode() + ' at position ' +\
+                str(tag.start(1) - 1) + ' exceeds the end of file')
+        if fields is None or name in fields:
+            record[name.decode()] = str(buf[pos:pos + length], 'utf-8', 'replace')
+        if not in_record:
+            start = tag.start(1) - 1
+        in_record = True
+        pos += length
+    if in_record:
+        raise AdifException('last record is not terminated with <EOR>')
+
+def qso_date(value):
+    """validates QSO_DATE value (YYYYMMDD), returns it as is so dates
+    can be compared as strings"""
+    if len(value) != 8 or not value.isdigit():
+        raise AdifException('bad QSO_DATE: ' + value)
+    return value
+
+def stats(buf):
+    """returns statistics of adi file computed in one pass:
+    qso_count, date_from, date_to, bands and modes histograms
+    raises AdifException if the file is malformed or has no records"""
+    qso_count = 0
+    date_from = date_to = None
+    bands = {}
+    modes = {}
+    for record in records(buf, fields={'QSO_DATE', 'BAND', 'MODE'}):
+        qso_count += 1
+        if 'QSO_DATE' in record:
+            value = qso_date(record['QSO_DATE'])
+            if not date_from or value < date_from:
+                date_from = value
+            if not date_to or value > date_to:
+                date_to = value
+        band = record.get('BAND', '').lower()
+        bands[band] = bands.get(band, 0) + 1
+        mode = record.get('MODE', '').upper()
+        modes[mode] = modes.get(mode, 0) + 1
+    if not qso_count:
+        raise AdifException('no QSO records')
+    return {'qso_count': qso_count,\
+        'date_from': to_date(date_from) if date_from else None,\
+        'date_to': to_date(date_to) if date_to else None,\
+        'bands': bands,\
+        'modes': modes}
+
+def to_date(value):
+    try:
+        return date(int(value[:4]), int(value[4:6]), int(value[6:]))
+    except ValueError:
+        raise AdifException('bad QSO_DATE: ' + value)
+
+def split(buf, max_records=None, max_bytes=None):
+    """splits adi file records into parts of up to max_records records
+    and up to max_bytes bytes (longer record makes a part alone)
+    returns list of parts (start, end) positions in buf"""
+    parts = []
+    start = end = None
+    count = 0
+    for _, rec_start, rec_end in records(buf, fields=set(), spans=True):
+        if start is not None and ((max_records and count >= max_records) or\
+            (max_bytes and rec_end - start > max_bytes)):
+            parts.append((start, end))
+            start = None
+        if start is None:
+            start = rec_start
+            count = 0
+        end = rec_end
+        count += 1
+    if start is not None:
+        parts.append((start, end))
+    return parts
+
+FINGERPRINT_FIELDS = {'CALL', 'QSO_DATE', 'TIME_ON', 'BAND', 'MODE'}
+
+def fingerprint(record):
+    """returns 64 bit signed int hash of qso's normalized
+    call, date, time (hours and minutes), band and mode"""
+    key = '|'.join((record.get('CALL', '').strip().upper(),\
+        record.get('QSO_DATE', '').strip(),\
+        record.get('TIME_ON', '').strip()[:4],\
+        record.get('BAND', '').strip().lower(),\
+        record.get('MODE', '').strip().upper()))
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(),\
+        'big', signed=True)
+
+def fingerprints(buf):
+    """returns arrays of fingerprints of adi file records and
+    their starts and ends in buf"""
+    fps, starts, ends = array.array('q'), array.array('q'), array.array('q')
+    for record, start, end in records(buf, fields=FINGERPRINT_FIELDS, spans=True):
+        fps.append(fingerprint(record))
+        starts.append(start)
+        ends.append(end)
+    return fps, starts, ends
@@ -0,0 +1,95 @@
+#!/usr/bin/python3
+#coding=utf-8
+"""http body compression for the api: gzip/deflate encoded request bodies
+are decoded on the fly by wsgi middleware, large responses are gzipped
+if the client accepts it"""
+import gzip
+import io
+import logging
+import zlib
+
+from flask import request
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge, UnsupportedMediaType
+from werkzeug.wsgi import get_input_stream
+
+READ_SIZE = 64 * 1024
+#zlib wbits of supported content encodings
+ENCODINGS = {'gzip': 16 + zlib.MAX_WBITS,\
+    'x-gzip': 16 + zlib.MAX_WBITS,\
+    'deflate': zlib.MAX_WBITS}
+
+class DecompressReader(io.RawIOBase):
+    """raw stream of decoded request body, decompresses at most the size
+    of the read buffer at once; raises RequestEntityTooLarge if decoded
+    body is larger than max_size (eg zip bomb), BadRequest if the body
+    is corrupted or truncated"""
+
+    def __init__(self, stream, wbits, max_size=None):
+        super().__init__()
+        self.__stream = stream
+        self.__decompressor = zlib.decompressobj(wbits)
+        self.__size = 0
+        self.max_size = max_size
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        chunk = b''
+        while not chunk:
+            if self.__decompressor.eof:
+                return 0
+            data = self.__decompressor.unconsumed_tail or self.__stream.read(READ_SIZE)
+            if not data:
+                raise BadRequest('Compressed request body is truncated')
+            try:
+                chunk = self.__decompressor.decompress(data, len(buf))
+            except zlib.error as exc:
+                raise BadRequest('Compressed request body is corrupted: ' + str(exc))
+        self.__size += len(chunk)
+        if self.max_size and self.__size > self.max_size:
+            raise RequestEntityTooLarge()
+        buf[:len(chunk)] = chunk
+        return len(chunk)
+
+class DecompressMiddleware():
+    """wsgi middleware decoding request bodies with Content-Encoding
+    gzip or deflate, so the app reads them as plain ones;
+    other encodings are rejected with 415"""
+
+    def __init__(self, app, max_size=None):
+        self.app = app
+        self.max_size = max_size
+
+    def __call__(self, environ, start_response):
+        encoding = environ.get('HTTP_CONTENT_ENCODING', '').strip().lower()
+        if encoding and encoding != 'identity':
+            if encoding not in ENCODINGS:
+                logging.debug('Unsupported request content encoding: ' + encoding)
+                return UnsupportedMediaType()(environ, start_response)
+            environ['wsgi.input'] = io.BufferedReader(\
+                DecompressReader(get_input_stream(environ), ENCODINGS[encoding],\
+                    self.max_size), READ_SIZE)
+            #decoded body length is unknown, it ends with the stream
+            environ['wsgi.input_terminated'] = True
+            environ.pop('CONTENT_LENGTH', None)
+            del environ['HTTP_CONTENT_ENCODING']
+        return self.app(environ, start_response)
+
+def compress_response(response, min_size=1024, level=6):
+    """flask after_request handler: gzips response body if it is
+    min_size bytes or larger and the client accepts gzip;
+    streamed responses (eg events, exports) are sent as is"""
+    if response.direct_passthrough or response.is_streamed or\
+        response.status_code < 200 or response.status_code in (204, 304) or\
+        'Content-Encoding' in response.headers:
+        return response
+    response.vary.add('Accept-Encoding')
+    if not request.accept_encodings['gzip']:
+        return response
+    data = response.get_data()
+    if len(data) < min_size:
+        return response
+    response.set_data(gzip.compress(data, compresslevel=level))
+    response.headers['Content-Encoding'] = 'gzip'
+    return response
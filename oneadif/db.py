@@ -2,10 +2,18 @@
 #coding=utf-8
 
 import logging
+import re
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+from functools import lru_cache
 import simplejson as json
 
 import psycopg2
-from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+import psycopg2.pool
+from psycopg2.extras import execute_batch, execute_values
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_UNKNOWN
 
 class OneadifDbException(Exception):
 
@@ -37,6 +45,51 @@ def to_dict(cur, keys=None):
     else:
         return False
 
+@lru_cache(maxsize=256)
+def row_class(columns_names):
+    """returns namedtuple class for tuple of columns names;
+    classes are cached so rows of the same query share one"""
+    return namedtuple('Row', columns_names, rename=True)
+
+class QueryResult():
+    """query result rows as namedtuples with explicit accessors
+    instead of to_dict return shapes"""
+    __slots__ = ('columns_names', 'rows')
+
+    def __init__(self, columns_names, rows):
+        self.columns_names = columns_names
+        self.rows = rows
+
+    @classmethod
+    def from_cursor(cls, cur):
+        if cur.description is None:
+            return cls((), [])
+        columns_names = tuple([col.name for col in cur.description])
+        return cls(columns_names, list(map(row_class(columns_names)._make, cur.fetchall())))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def all(self):
+        """returns list of rows"""
+        return self.rows
+
+    def one(self):
+        """returns first row or None"""
+        return self.rows[0] if self.rows else None
+
+    def scalar(self):
+        """returns first column of first row or None"""
+        return self.rows[0][0] if self.rows else None
+
+    def by_key(self, key='id'):
+        """returns dict of rows by key column value"""
+        idx = self.columns_names.index(key)
+        return {row[idx]: row for row in self.rows}
+
 def typed_values_list(_list, _type=None):
     """convert list to values string, skips values not of specified type if
     type is specified"""
@@ -54,10 +107,47 @@ def splice_params(data, *params):
         for param in params \
         if param in data}
 
+PARAM_RE = re.compile(r'%\((\w+)\)s')
+
+def positional_params(sql):
+    """replaces named params placeholders with positional ones ($1, $2...)
+    returns sql and list of params names in positional order"""
+    names = []
+
+    def _replace(match):
+        name = match.group(1)
+        if name not in names:
+            names.append(name)
+        return '$' + str(names.index(name) + 1)
+
+    return PARAM_RE.sub(_replace, sql), names
+
+def params_key(params):
+    """returns sorted tuple of params names for prepared statements cache key"""
+    return tuple(sorted(params.keys()))
+
+def pages(_list, page_size):
+    """splits list to slices of page_size length"""
+    for idx in range(0, len(_list), page_size):
+        yield _list[idx:idx + page_size]
+
 def init_connection(conn):
     conn.set_client_encoding('UTF8')
     logging.debug('new db connection')
 
+class Connection(psycopg2.extensions.connection):
+    """psycopg2 connection keeping the time of the last checkin to pool
+    and server-side prepared statements of the session"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.last_used = time.time()
+        self.prepared = OrderedDict()
+        self.prepared_count = 0
+        #guards prepared statements cache when the connection is shared
+        self.lock = threading.RLock()
+        init_connection(self)
+
 def exec_cur(cur, sql, params=None):
     try:
         cur.execute(sql, params)
@@ -78,6 +168,10 @@ def trap_db_exception(exc, sql, params=None):
         logging.error("Params: ")
         logging.error(params)
 
+class DBPoolTimeout(Exception):
+    """No pooled connection was released in time"""
+    pass
+
 class DBConn:
 
     def __init__(self, db_params, verbose=False):
@@ -86,65 +180,383 @@ class DBConn:
         self.pool = None
         self.error = None
         self.conn = None
+        self.ping_interval = 30
+        self.pool_timeout = 10
+        self.prepared_cache_size = 64
+        self.__pool_slots = None
+        self.__local = threading.local()
+        self.__connect_lock = threading.Lock()
 
-    def connect(self):
+    def connect(self, minconn=None, maxconn=None):
+        """creates single db connection or, if maxconn is specified,
+        pool of connections checked out by threads"""
         try:
-            self.conn = psycopg2.connect(self.dsn)
-            init_connection(self.conn)
-            logging.debug('db connection was created')
+            if maxconn:
+                self.pool = psycopg2.pool.ThreadedConnectionPool(minconn or 1, maxconn,\
+                    self.dsn, connection_factory=Connection)
+                #psycopg2 pool closes returned connections when it has minconn
+                #idle ones; they are kept up to maxconn instead of reconnecting
+                self.pool.minconn = maxconn
+                self.__pool_slots = threading.BoundedSemaphore(maxconn)
+                logging.debug('db connection pool was created')
+            else:
+                self.conn = psycopg2.connect(self.dsn, connection_factory=Connection)
+                logging.debug('db connection was created')
         except Exception:
             logging.exception('Error creating db connection')
             logging.error(self.dsn)
 
+    def __healthy(self, conn):
+        if conn.closed or conn.get_transaction_status() == TRANSACTION_STATUS_UNKNOWN:
+            return False
+        if time.time() - conn.last_used > self.ping_interval:
+            try:
+                with conn.cursor() as cur:
+                    cur.execute('select 1')
+                conn.rollback()
+            except psycopg2.Error:
+                logging.debug('broken db connection was dropped from pool')
+                return False
+        return True
+
+    def __getconn(self):
+        """takes healthy connection from the pool, waits up to pool_timeout
+        seconds if all of them are checked out and raises DBPoolTimeout
+        after that"""
+        if not self.__pool_slots.acquire(timeout=self.pool_timeout):
+            logging.error('db connection pool is exhausted')
+            raise DBPoolTimeout('No db connection available in ' +\
+                str(self.pool_timeout) + ' seconds')
+        try:
+            while True:
+                conn = self.pool.getconn()
+                if self.__healthy(conn):
+                    return conn
+                self.pool.putconn(conn, close=True)
+        except Exception:
+            self.__pool_slots.release()
+            raise
+
+    def __putconn(self, conn):
+        broken = bool(conn.closed)
+        if not broken and conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+        conn.last_used = time.time()
+        try:
+            self.pool.putconn(conn, close=broken)
+        finally:
+            self.__pool_slots.release()
+
+    def checkout(self, lazy=False):
+        """binds pooled connection to the current thread until release();
+        if lazy is set the connection is taken from the pool on its first
+        use, so the thread which does not query db does not hold it"""
+        if self.pool and not getattr(self.__local, 'conn', None):
+            if lazy:
+                self.__local.lazy = True
+            else:
+                self.__local.conn = self.__getconn()
+
+    def release(self, exc=None):
+        """returns connection bound to the current thread to the pool;
+        can be used as flask teardown_request callback"""
+        self.__local.lazy = False
+        conn = getattr(self.__local, 'conn', None)
+        if conn:
+            self.__local.conn = None
+            self.__putconn(conn)
+
+    @property
+    def in_transaction(self):
+        """true if the current thread is inside transaction() block"""
+        return bool(getattr(self.__local, 'tx_depth', 0))
+
+    @contextmanager
+    def transaction(self):
+        """groups execute calls of the current thread into single transaction
+        which is committed on exit or rolled back on exception;
+        nested blocks use savepoints. Inside the block execute errors
+        are raised instead of returning False.
+        In single connection mode other threads wait for the end
+        of the transaction to use the connection."""
+        depth = getattr(self.__local, 'tx_depth', 0)
+        checkout = self.pool and not getattr(self.__local, 'conn', None) and\
+            not getattr(self.__local, 'lazy', False)
+        if checkout:
+            self.checkout()
+        try:
+            with self.connection() as conn:
+                savepoint = 'oneadif_savepoint_' + str(depth)
+                if depth:
+                    with conn.cursor() as cur:
+                        cur.execute('savepoint ' + savepoint)
+                self.__local.tx_depth = depth + 1
+                try:
+                    yield conn
+                except Exception:
+                    if not conn.closed:
+                        if depth:
+                            with conn.cursor() as cur:
+                                cur.execute('rollback to savepoint ' + savepoint)
+                        else:
+                            conn.rollback()
+                    raise
+                else:
+                    if depth:
+                        with conn.cursor() as cur:
+                            cur.execute('release savepoint ' + savepoint)
+                    else:
+                        conn.commit()
+                finally:
+                    self.__local.tx_depth = depth
+        finally:
+            if checkout:
+                self.release()
+
+    @contextmanager
+    def connection(self):
+        """yields connection for the current thread: the one checked out
+        by the thread (taken from the pool on the first use after lazy
+        checkout), temporary one from the pool or the single connection
+        (reconnecting if it was broken) locked for the current thread"""
+        if not self.pool:
+            with self.__connect_lock:
+                if not self.conn or self.conn.closed:
+                    self.connect()
+                conn = self.conn
+            #the single connection is used by one thread at a time,
+            #transaction() holds it for the whole block
+            with conn.lock:
+                yield conn
+            return
+        conn = getattr(self.__local, 'conn', None)
+        if conn:
+            yield conn
+            return
+        if getattr(self.__local, 'lazy', False):
+            self.__local.conn = self.__getconn()
+            yield self.__local.conn
+            return
+        conn = self.__getconn()
+        try:
+            yield conn
+        finally:
+            self.__putconn(conn)
+
     def param_update(self, table, id_params, upd_params):
         return self.execute('update ' + table + \
                 ' set ' + params_str(upd_params, ', ') + \
                 " where " + params_str(id_params, ' and '), \
-                dict(id_params, **upd_params))
+                dict(id_params, **upd_params),\
+                prepare=('update', table, params_key(id_params), params_key(upd_params)))
 
     def param_delete(self, table, id_params):
         return self.execute('delete from ' + table + \
                 " where " + params_str(id_params, ' and ') +\
-                " returning *", id_params)
+                " returning *", id_params,\
+                prepare=('delete', table, params_key(id_params)))
 
     def param_upsert(self, table, id_params, upd_params):
-        lookup = self.get_object(table, id_params, create=False)
-        res = None
-        if lookup:
-            res = self.param_update(table, id_params, upd_params)
+        with self.transaction():
+            lookup = self.get_object(table, id_params, create=False)
+            res = None
+            if lookup:
+                res = self.param_update(table, id_params, upd_params)
+            else:
+                res = self.get_object(table, dict(id_params, **upd_params), create=True)
+        return res
+
+    def upsert(self, table, id_params, upd_params):
+        """inserts or updates row in single statement, requires unique
+        constraint on id_params columns
+        returns resulting row"""
+        params = dict(id_params, **upd_params)
+        keys = params.keys()
+        return self.execute("insert into " + table + " (" + \
+                ", ".join(keys) + ") values (" + \
+                ', '.join(["%(" + k + ")s" for k in keys]) + \
+                ") on conflict (" + ", ".join(id_params.keys()) + ") do update set " + \
+                ", ".join([k + " = excluded." + k for k in upd_params.keys()]) + \
+                " returning *", params,\
+                prepare=('upsert', table, params_key(id_params), params_key(upd_params)))
+
+    def __prepare(self, conn, cur, key, sql):
+        """returns name and params names of server-side prepared statement
+        for key, prepares it in connection's session if it was not cached;
+        least recently used statements are deallocated when cache is full"""
+        with conn.lock:
+            if key in conn.prepared:
+                conn.prepared.move_to_end(key)
+                return conn.prepared[key]
+            conn.prepared_count += 1
+            name = 'oneadif_stmt_' + str(conn.prepared_count)
+            prepared_sql, names = positional_params(sql)
+            cur.execute('prepare ' + name + ' as ' + prepared_sql)
+            conn.prepared[key] = (name, names)
+            if len(conn.prepared) > self.prepared_cache_size:
+                _, (lru_name, _) = conn.prepared.popitem(last=False)
+                cur.execute('deallocate ' + lru_name)
+            return name, names
+
+    @staticmethod
+    def __drop_prepared(conn, cur, key, exc):
+        """drops prepared statement of key from the cache if exc shows
+        that it is invalid: the statement does not exist in the session
+        or its result type was changed by alter table (cached plan
+        must not change result type); the latter one is deallocated,
+        so it has to be called after rollback
+        returns true if the statement was dropped"""
+        pgcode = getattr(exc, 'pgcode', None)
+        if pgcode not in ('26000', '0A000'):
+            return False
+        with conn.lock:
+            stmt = conn.prepared.pop(key, None)
+            if not stmt:
+                return False
+            if pgcode == '0A000':
+                #prepare and deallocate are not transactional
+                try:
+                    cur.execute('deallocate ' + stmt[0])
+                    conn.commit()
+                except psycopg2.Error:
+                    conn.rollback()
+                    logging.exception('deallocate ' + stmt[0] + ' failed')
+        logging.debug('invalid prepared statement ' + stmt[0] + ' was dropped')
+        return True
+
+    def query(self, sql, params=None, prepare=None):
+        """executes sql, returns QueryResult or False on error"""
+        return self.execute(sql, params, prepare=prepare, typed=True)
+
+    def execute(self, sql, params=None, keys=None, progress=None, page_size=100,\
+        prepare=None, typed=False):
+        """executes sql; if prepare (hashable cache key) is specified
+        and params is a dict sql is run as cached prepared statement
+        (inside transaction() block statements are not prepared, so changes
+        of the schema do not break the transaction);
+        if typed is true results are returned as QueryResult"""
+        res = False
+        if self.in_transaction:
+            prepare = None
+        with self.connection() as conn, conn.cursor() as cur:
+            #statement invalidated by the schema change is prepared again
+            for retry in (True, False):
+                try:
+                    res = self.__execute(conn, cur, sql, params, keys, progress,\
+                        page_size, prepare, typed)
+                    break
+                except Exception as exc:
+                    if self.in_transaction:
+                        trap_db_exception(exc, sql, params)
+                        raise
+                    if not conn.closed:
+                        conn.rollback()
+                        if prepare and self.__drop_prepared(conn, cur, prepare, exc) and retry:
+                            continue
+                    trap_db_exception(exc, sql, params)
+                    break
+        return res
+
+    def __execute(self, conn, cur, sql, params, keys, progress, page_size, prepare, typed):
+        if self.verbose:
+            logging.debug(sql)
+            logging.debug(params)
+        res = False
+        if not params or isinstance(params, dict):
+            if prepare:
+                name, names = self.__prepare(conn, cur, prepare, sql)
+                cur.execute('execute ' + name +\
+                    (' (' + ', '.join(["%(" + k + ")s" for k in names]) + ')'\
+                        if names else ''), params)
+            else:
+                cur.execute(sql, params)
+            if typed:
+                res = QueryResult.from_cursor(cur)
+            else:
+                res = to_dict(cur, keys)\
+                    if cur.description != None else True
         else:
-            res = self.get_object(table, dict(id_params, **upd_params), create=True)
+            cnt = 0
+            for page in pages(params, page_size):
+                execute_batch(cur, sql, page, page_size=page_size)
+                cnt += len(page)
+                if progress:
+                    logging.debug(str(cnt) + '/' + str(len(params)))
+            res = True
+        if not self.in_transaction:
+            conn.commit()
         return res
 
-    def execute(self, sql, params=None, keys=None, progress=None):
+    def execute_bulk(self, sql, params, template=None, page_size=1000):
+        """executes sql with single VALUES %s placeholder for list of params
+        sending page_size rows per statement
+        returns number of affected rows or False on error"""
         res = False
-        with self.conn.cursor() as cur:
+        with self.connection() as conn, conn.cursor() as cur:
             try:
                 if self.verbose:
                     logging.debug(sql)
-                    logging.debug(params)
-                if not params or isinstance(params, dict):
-                    cur.execute(sql, params)
-                    res = to_dict(cur, keys)\
-                        if cur.description != None else True
-                else:
-                    cnt = 0
-                    cnt0 = 0
-                    for item in params:
-                        cnt0 += 1
-                        cur.execute(sql, item)
-                        if cnt0 == 100:
-                            cnt += cnt0
-                            cnt0 = 0
-                            if progress:
-                                logging.debug(str(cnt) + '/' + str(len(params)))
-                    res = True
-                self.conn.commit()
+                    logging.debug(str(len(params)) + ' rows')
+                res = 0
+                for page in pages(params, page_size):
+                    execute_values(cur, sql, page, template=template, page_size=page_size)
+                    res += cur.rowcount
+                if not self.in_transaction:
+                    conn.commit()
             except Exception as exc:
-                self.conn.rollback()
-                trap_db_exception(exc, sql, params)
+                res = False
+                if self.in_transaction:
+                    trap_db_exception(exc, sql)
+                    raise
+                if not conn.closed:
+                    conn.rollback()
+                trap_db_exception(exc, sql)
         return res
 
+    def bulk_insert(self, table, rows, on_conflict='', page_size=1000):
+        """inserts list of dicts with the same keys into table
+        returns number of inserted rows or False on error"""
+        if not rows:
+            return 0
+        keys = list(rows[0].keys())
+        sql = "insert into " + table + " (" + ", ".join(keys) + ") values %s " + on_conflict
+        template = "(" + ', '.join(["%(" + k + ")s" for k in keys]) + ")"
+        return self.execute_bulk(sql, rows, template=template, page_size=page_size)
+
+    def iterate(self, sql, params=None, chunk_size=1000):
+        """executes query with server-side cursor on a separate connection
+        yields lists of rows (dicts) of chunk_size length;
+        can be consumed after the request or thread which started it"""
+        if self.verbose:
+            logging.debug(sql)
+            logging.debug(params)
+        conn = self.__getconn() if self.pool else\
+            psycopg2.connect(self.dsn, connection_factory=Connection)
+        try:
+            with conn.cursor(name='oneadif_iterate') as cur:
+                cur.itersize = chunk_size
+                cur.execute(sql, params)
+                while True:
+                    data = cur.fetchmany(chunk_size)
+                    if not data:
+                        break
+                    columns_names = [col.name for col in cur.description]
+                    yield [dict(zip(columns_names, row)) for row in data]
+            conn.commit()
+        except Exception as exc:
+            if not conn.closed:
+                conn.rollback()
+            trap_db_exception(exc, sql, params)
+            raise
+        finally:
+            if self.pool:
+                self.__putconn(conn)
+            else:
+                conn.close()
+
     def get_object(self, table, params, create=None):
         sql = ''
         res = False
@@ -155,7 +567,9 @@ class DBConn:
                     if params[k] != None\
                     else k + " is null"\
                     for k in params.keys()]))
-            res = self.execute(sql, params)
+            res = self.execute(sql, params,\
+                prepare=('select', table, params_key(params),\
+                    tuple(sorted([k for k in params if params[k] is None]))))
         if create or (not res and create != False):
             keys = params.keys()
             sql = "insert into " + table + " (" + \
@@ -163,6 +577,6 @@ class DBConn:
                 ', '.join(["%(" + k + ")s" for k in keys]) + \
                 ") returning *"
             logging.debug('creating object in db')
-            res = self.execute(sql, params)
+            res = self.execute(sql, params, prepare=('insert', table, params_key(params)))
         return res
 
@@ -1,50 +1,172 @@
 #!/usr/bin/python3
 #coding=utf-8
 """class for working with web-loggers. Currenly supported: LOTW"""
+import base64
 import logging
-import io
+import re
+import threading
+import time
+import zlib
+import asyncio
 from asyncio import CancelledError
+from concurrent.futures import Future, ThreadPoolExecutor
 
 import requests
 import simplejson as json
+try:
+    import aiohttp
+except ImportError:
+    #required only by asyncio upload server engine
+    aiohttp = None
+
+HEADERS = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/74.0.3729.131 Safari/537.36'}
+UPLOAD_CHUNK_SIZE = 64 * 1024
+AUTH_FAILED_STATUSES = (401, 403)
+JSON_ESCAPE_RE = re.compile(r'[^\x20-\x7e]|["\\]')
 
 class ELogException(Exception):
     """Login failed"""
     pass
 
+class LoginCancelled(Exception):
+    """Shared login was cancelled by the task which started it"""
+    pass
+
 def eqsl_date_format(_dt):
     """formats date for eqsl url params: mm%2Fdd%2Fyyyy"""
     return _dt.strftime('%m%%2F%d%%2F%Y')
 
-class ProgressBufferReader(io.BytesIO):
-    def __init__(self, buf, callback=None, cancel_event=None):
+class Base64Content():
+    """bytes-like content (eg mmap of stored file) or its [start:end] range
+    encoded to base64 chunk by chunk while request body is sent"""
+
+    def __init__(self, buf, prefix='', start=0, end=None):
+        self.buf = buf
+        self.prefix = prefix
+        self.start = start
+        self.end = len(buf) if end is None else end
+
+    def __len__(self):
+        return len(self.prefix) + (self.end - self.start + 2) // 3 * 4
+
+    def __iter__(self):
+        if self.prefix:
+            yield self.prefix.encode()
+        #chunks of multiple of 3 bytes encode without padding
+        step = UPLOAD_CHUNK_SIZE // 4 * 3
+        for pos in range(self.start, self.end, step):
+            yield base64.b64encode(self.buf[pos:min(pos + step, self.end)])
+
+    def close(self):
+        if hasattr(self.buf, 'close'):
+            self.buf.close()
+
+def part_chunks(part):
+    """splits body part (bytes-like, ascii str or Base64Content)
+    into chunks of bytes"""
+    if isinstance(part, Base64Content):
+        yield from part
+        return
+    if not isinstance(part, str):
+        part = memoryview(part).cast('B')
+    for pos in range(0, len(part), UPLOAD_CHUNK_SIZE):
+        chunk = part[pos:pos + UPLOAD_CHUNK_SIZE]
+        yield chunk.encode('ascii') if isinstance(chunk, str) else chunk
+
+class UploadBody():
+    """upload request body streamed in chunks from its parts
+    without joining them into one buffer; reports progress
+    and checks for cancel on every chunk"""
+
+    def __init__(self, parts, callback=None, cancel_event=None):
+        self._parts = parts
         self._callback = callback
         self._cancel_event = cancel_event
-        bbuf = buf.encode()
-        self._len = len(bbuf)
-        self._progress = 0
-        io.BytesIO.__init__(self, bbuf)
+        self._len = sum([len(part) for part in parts])
 
     def __len__(self):
         return self._len
 
-    def read(self, n=-1):
-        if self._cancel_event and self._cancel_event.is_set():
-            raise CancelledError('The upload was cancelled.')
-        chunk = io.BytesIO.read(self, n)
-        self._progress += int(len(chunk))
-        if self._callback:
-            self._callback(self._progress/self._len)
-        return chunk
+    def __iter__(self):
+        progress = 0
+        for part in self._parts:
+            for chunk in part_chunks(part):
+                if self._cancel_event and self._cancel_event.is_set():
+                    raise CancelledError('The upload was cancelled.')
+                yield chunk
+                progress += len(chunk)
+                if self._callback:
+                    self._callback(progress/self._len)
+
+def gzip_chunks(chunks, level=6):
+    """compresses chunks of request body into gzip stream on the fly"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+class UploadProgress():
+    """sums up progress of files uploaded concurrently weighted by their
+    sizes; callback is called under lock so it has one caller at a time"""
+
+    def __init__(self, sizes, callback):
+        self.__sizes = sizes
+        self.__total = sum(sizes) or 1
+        self.__done = [0] * len(sizes)
+        self.__callback = callback
+        self.__lock = threading.Lock()
+
+    def file_callback(self, idx):
+        """returns progress callback of the file"""
+        if not self.__callback:
+            return None
+
+        def callback(progress):
+            with self.__lock:
+                self.__done[idx] = progress * self.__sizes[idx]
+                self.__callback(sum(self.__done)/self.__total)
+
+        return callback
+
+def split_results(results):
+    """returns upload results and auth_failed flag of any of them
+    from (result, auth_failed) pairs of files uploads"""
+    return [result for result, _ in results],\
+        any(auth_failed for _, auth_failed in results)
+
+def json_parts(data, obj, key, value):
+    """returns json of data with long string value of obj[key] (obj is
+    data or its nested dict) as parts: json before the value, the value,
+    json after the value; str value is escaped only if it has to be,
+    Base64Content needs no escaping"""
+    placeholder = '__ONEADIF_VALUE__'
+    obj[key] = placeholder
+    head, tail = json.dumps(data).split(placeholder, 1)
+    if isinstance(value, str) and JSON_ESCAPE_RE.search(value):
+        value = json.dumps(value)[1:-1]
+    return [head.encode(), value, tail.encode()]
 
 class ELog():
 
     default_login_data_fields = ['login', 'password']
 
+    #upload limits: maxRecords - max qsos per request, maxBytes - max size of
+    #upload request body (before compression) with base64 encoded adif,
+    #larger logs are split into parts sent by up to maxParts requests at once
+    #compress - elog accepts gzip encoded upload requests (aiohttp server
+    #decodes them)
     types = {'LoTW': {},\
             'eQSL': {\
                  'loginDataFields': ['Callsign', 'EnteredPassword'],\
                  'schema': 'extLoggersLoginEQSL'\
+                },\
+            'dev.cfmrda': {\
+                'maxRecords': 5000,\
+                'maxBytes': 4 * 1024 * 1024,\
+                'maxParts': 4,\
+                'compress': True\
                 }
             }
 
@@ -57,10 +179,8 @@ class ELog():
         self.login_data = None
         self.auth_token = None
 
-    def login(self, login_data):
-        ssn = requests.Session()
-        rsp = None
-        ssn.headers.update({'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/74.0.3729.131 Safari/537.36'})
+    def login_request(self, login_data):
+        """returns login request url and data"""
         data = {}
         data.update(login_data)
 
@@ -69,50 +189,70 @@ class ELog():
                 'acct_sel': '',\
                 'thisForm': 'login'\
             })
-            rsp = ssn.post('https://lotw.arrl.org/lotwuser/login', data=data)
-            rsp.raise_for_status()
-            if 'Username/password incorrect' in rsp.text:
-                raise ELogException("Login failed.")
+            return 'https://lotw.arrl.org/lotwuser/login', data
 
         elif self.type == 'HAMLOG':
-            rsp = ssn.post('https://hamlog.ru/lk/login.php', data=data)
-            rsp.raise_for_status()
-            if 'Ошибка! Неверный адрес и/или пароль' in rsp.text:
-                raise ELogException("Login failed.")
+            return 'https://hamlog.ru/lk/login.php', data
 
         elif self.type == 'eQSL':
             data.update({\
                 'Login': 'Go'\
             })
-            rsp = ssn.post('https://www.eqsl.cc/QSLCard/LoginFinish.cfm', data=data)
-            rsp.raise_for_status()
-            if 'Callsign or Password Error!' in rsp.text:
-                raise ELogException("Login failed.")
+            return 'https://www.eqsl.cc/QSLCard/LoginFinish.cfm', data
 
         elif self.type == 'dev.cfmrda':
             data.update({'mode': 'login'})
-            rsp = ssn.post('https://dev.cfmrda.ru/aiohttp/login', data=json.dumps(data))
-            rsp.raise_for_status()
-            rsp_data = rsp.json()
+            return 'https://dev.cfmrda.ru/aiohttp/login', json.dumps(data)
+
+        return None, None
+
+    def check_login(self, rsp_text):
+        """checks login response text, raises ELogException
+        if login failed"""
+        if self.type == 'LoTW':
+            if 'Username/password incorrect' in rsp_text:
+                raise ELogException("Login failed.")
+
+        elif self.type == 'HAMLOG':
+            if 'Ошибка! Неверный адрес и/или пароль' in rsp_text:
+                raise ELogException("Login failed.")
+
+        elif self.type == 'eQSL':
+            if 'Callsign or Password Error!' in rsp_text:
+                raise ELogException("Login failed.")
+
+        elif self.type == 'dev.cfmrda':
+            rsp_data = json.loads(rsp_text)
             self.auth_token = rsp_data['token']
 
+    def login(self, login_data):
+        ssn = requests.Session()
+        ssn.headers.update(HEADERS)
+        url, data = self.login_request(login_data)
+        if url:
+            rsp = ssn.post(url, data=data)
+            rsp.raise_for_status()
+            self.check_login(rsp.text)
+
         self.login_data = login_data
         self.session = ssn
 
         return ssn
 
-    def upload(self, file, params, callback=None, cancel_event=None):
-
+    def upload_request(self, file, params):
+        """returns upload request url and list of body parts"""
         data = {}
         data.update(params)
         url = None
-        data_string = None
+        body_parts = None
 
         if self.type == 'dev.cfmrda':
             file_entry = {}
             file_entry.update(file)
             file_entry['rda'] = data['rda']
             del data['rda']
+            file_content = file_entry.pop('file')
+            file_entry['file'] = None
             data.update({
                 'stationCallsignFieldEnable': True,
                 'rdaFieldEnable': False,
@@ -120,16 +260,231 @@ class ELog():
                 'files': [file_entry]
                 })
             url = 'https://dev.cfmrda.ru/aiohttp/adif'
-            data_string = json.dumps(data)
+            body_parts = json_parts(data, file_entry, 'file', file_content)
+
+        return url, body_parts
+
+    def upload_envelope_size(self, file, params):
+        """returns size of upload request body without the file content"""
+        _, body_parts = self.upload_request(dict(file, file=''), params)
+        return sum(len(part) for part in body_parts) if body_parts else 0
+
+    def upload_data(self, body):
+        """returns request data and headers of upload body: gzip stream
+        of the body if the elog accepts compressed uploads"""
+        if ELog.types.get(self.type, {}).get('compress'):
+            return gzip_chunks(body), {'Content-Encoding': 'gzip'}
+        return body, {}
+
+    def upload(self, file, params, callback=None, cancel_event=None):
+        return self.upload_many([file], params, callback=callback,\
+            cancel_event=cancel_event)[0][0]
+
+    def upload_many(self, files, params, callback=None, cancel_event=None, max_parts=1,\
+        file_uploaded=None):
+        """uploads files (parts of log) by up to max_parts requests at once
+        returns list of results (True if the file was uploaded) and
+        auth_failed (True if the elog rejected the session, so the files
+        have to be sent again after login);
+        callback receives progress of all the files,
+        file_uploaded(file) is called when the file is accepted by the elog"""
+        progress = UploadProgress([len(file['file']) for file in files], callback)
+        if len(files) == 1 or max_parts < 2:
+            results = [self.__upload_file(file, params, progress.file_callback(idx),\
+                    cancel_event, file_uploaded)\
+                for idx, file in enumerate(files)]
+        else:
+            with ThreadPoolExecutor(min(max_parts, len(files))) as executor:
+                futures = [executor.submit(self.__upload_file, file, params,\
+                        progress.file_callback(idx), cancel_event, file_uploaded)\
+                    for idx, file in enumerate(files)]
+                results = [future.result() for future in futures]
+        return split_results(results)
+
+    def __upload_file(self, file, params, callback, cancel_event, file_uploaded):
+        """returns result of the upload and auth_failed flag"""
+
+        url, body_parts = self.upload_request(file, params)
+        auth_failed = False
 
         try:
-            data_buffer = ProgressBufferReader(data_string, callback, cancel_event)
-            rsp = requests.post(url, data=data_buffer)
+            body = UploadBody(body_parts, callback, cancel_event)
+            data, headers = self.upload_data(body)
+            rsp = self.session.post(url, data=data, headers=headers)
+            auth_failed = rsp.status_code in AUTH_FAILED_STATUSES
             rsp.raise_for_status()
             logging.debug(rsp.text)
-            return True
+            if file_uploaded:
+                file_uploaded(file)
+            return True, False
         except CancelledError:
             raise CancelledError
         except Exception:
             logging.exception(self.type + ' upload error')
-            return False
+            return False, auth_failed
+
+    async def login_async(self, login_data):
+        """login for asyncio upload server engine, the session has to be
+        closed with close_async()"""
+        self.session = aiohttp.ClientSession(headers=HEADERS)
+        url, data = self.login_request(login_data)
+        if url:
+            async with self.session.post(url, data=data) as rsp:
+                rsp.raise_for_status()
+                self.check_login(await rsp.text())
+
+        self.login_data = login_data
+
+        return self.session
+
+    async def upload_async(self, file, params, callback=None):
+        """upload for asyncio upload server engine; cancelled
+        with the task running it"""
+        return (await self.upload_many_async([file], params, callback=callback))[0][0]
+
+    async def upload_many_async(self, files, params, callback=None, max_parts=1,\
+        file_uploaded=None):
+        """upload_many for asyncio upload server engine"""
+        progress = UploadProgress([len(file['file']) for file in files], callback)
+        running = asyncio.Semaphore(max_parts)
+
+        async def upload_file(idx, file):
+            async with running:
+                return await self.__upload_file_async(file, params,\
+                    progress.file_callback(idx), file_uploaded)
+
+        return split_results(await asyncio.gather(*[upload_file(idx, file)\
+            for idx, file in enumerate(files)]))
+
+    async def __upload_file_async(self, file, params, callback, file_uploaded):
+
+        url, body_parts = self.upload_request(file, params)
+        auth_failed = False
+
+        async def body_chunks(data):
+            for chunk in data:
+                yield chunk
+
+        try:
+            body = UploadBody(body_parts, callback)
+            data, headers = self.upload_data(body)
+            if data is body:
+                headers['Content-Length'] = str(len(body))
+            async with self.session.post(url, data=body_chunks(data),\
+                headers=headers) as rsp:
+                auth_failed = rsp.status in AUTH_FAILED_STATUSES
+                rsp.raise_for_status()
+                logging.debug(await rsp.text())
+            if file_uploaded:
+                file_uploaded(file)
+            return True, False
+        except CancelledError:
+            raise
+        except Exception:
+            logging.exception(self.type + ' upload error')
+            return False, auth_failed
+
+    async def close_async(self):
+        if self.session:
+            await self.session.close()
+
+class SessionCache():
+    """logged in ELog objects (with their sessions) by account key;
+    entries expire after ttl seconds or when login data changes,
+    concurrent logins of the same account share one login request"""
+
+    def __init__(self, ttl=600, max_size=1024):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.__entries = {}
+        self.__logins = {}
+        self.__lock = threading.Lock()
+
+    def __cached(self, key, login_data):
+        entry = self.__entries.get(key)
+        if entry and entry[1] > time.time() and entry[0].login_data == login_data:
+            return entry[0]
+        return None
+
+    def __store(self, key, elog):
+        if len(self.__entries) >= self.max_size:
+            now = time.time()
+            for entry_key in [k for k, v in self.__entries.items() if v[1] <= now] or\
+                [min(self.__entries, key=lambda k: self.__entries[k][1])]:
+                self.__close(self.__entries.pop(entry_key)[0])
+        old = self.__entries.get(key)
+        self.__entries[key] = (elog, time.time() + self.ttl)
+        if old:
+            self.__close(old[0])
+
+    @staticmethod
+    def __close(elog):
+        if isinstance(elog.session, requests.Session):
+            elog.session.close()
+        elif elog.session:
+            asyncio.ensure_future(elog.close_async())
+
+    def get(self, key, elog_type, login_data):
+        """returns logged in ELog for key (account id, elog type),
+        logs in if there is no valid cached one or waits for the login
+        already started by another thread;
+        login errors are raised to all waiting threads"""
+        with self.__lock:
+            elog = self.__cached(key, login_data)
+            if elog:
+                return elog
+            flight = self.__logins.get(key)
+            leader = not flight
+            if leader:
+                flight = self.__logins[key] = Future()
+        if not leader:
+            return flight.result()
+        try:
+            elog = ELog(elog_type)
+            elog.login(login_data)
+            with self.__lock:
+                self.__store(key, elog)
+            flight.set_result(elog)
+            return elog
+        except BaseException as exc:
+            flight.set_exception(exc)
+            raise
+        finally:
+            with self.__lock:
+                del self.__logins[key]
+
+    async def get_async(self, key, elog_type, login_data):
+        """get() for asyncio upload server engine"""
+        while True:
+            elog = self.__cached(key, login_data)
+            if elog:
+                return elog
+            if key not in self.__logins:
+                break
+            try:
+                return await asyncio.shield(self.__logins[key])
+            except LoginCancelled:
+                continue
+        flight = self.__logins[key] = asyncio.get_running_loop().create_future()
+        elog = ELog(elog_type)
+        try:
+            await elog.login_async(login_data)
+            self.__store(key, elog)
+            flight.set_result(elog)
+            return elog
+        except BaseException as exc:
+            #waiters retry the login if its task was cancelled
+            flight.set_exception(LoginCancelled() if isinstance(exc, CancelledError) else exc)
+            #mark exception retrieved, there may be no waiters
+            flight.exception()
+            await elog.close_async()
+            raise
+        finally:
+            del self.__logins[key]
+
+    def invalidate(self, key):
+        """drops cached login, eg when the elog rejected its session"""
+        with self.__lock:
+            entry = self.__entries.pop(key, None)
+        if entry:
+            self.__close(entry[0])
@@ -0,0 +1,239 @@
+#!/usr/bin/python3
+#coding=utf-8
+"""content-addressed store of uploaded files on local disk
+api stores file once under sha256 of its content and passes the hash (ref)
+to the upload server; upload workers map the file into memory instead of
+receiving its content through ipc.
+If the store is created with db, stored files are registered in files table:
+statistics of the file are cached there (so the same file is parsed once),
+uploads using the file hold references to it; files which are not referenced
+are evicted in least recently used order when the store grows over max_size"""
+import hashlib
+import io
+import logging
+import mmap
+import os
+import tempfile
+
+import simplejson as json
+
+from json_utils import json_encode_extra
+
+class FileStoreException(Exception):
+    """File cannot be stored"""
+    pass
+
+def map_file(path):
+    """returns read-only mmap of the file (bytes for empty file)"""
+    with open(path, 'rb') as mapped_file:
+        if not os.fstat(mapped_file.fileno()).st_size:
+            return b''
+        return mmap.mmap(mapped_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+class SpoolFile(io.FileIO):
+    """temporary file of the store (spool), its content is hashed while it
+    is written; data over max_size is not written, too_large is set instead
+    (so the file can be written by parsers which do not expect exceptions,
+    eg as werkzeug stream_factory)"""
+
+    def __init__(self, dir_path, max_size=None):
+        tmp_fd, self.path = tempfile.mkstemp(dir=dir_path, prefix='spool')
+        super().__init__(tmp_fd, 'w+b')
+        self.max_size = max_size
+        self.size = 0
+        self.too_large = False
+        self.__hash = hashlib.sha256()
+
+    def write(self, data):
+        self.size += len(data)
+        if self.too_large or (self.max_size and self.size > self.max_size):
+            self.too_large = True
+            return len(data)
+        self.__hash.update(data)
+        view = memoryview(data)
+        while view:
+            view = view[super().write(view):]
+        return len(data)
+
+    @property
+    def ref(self):
+        """ref of the content written"""
+        return self.__hash.hexdigest()
+
+class FileStore():
+
+    def __init__(self, path, db=None, max_size=None, grace=3600):
+        """grace (seconds): recently used files are never evicted,
+        so the file stored by api is not lost before its upload is queued"""
+        self.path = path
+        self.db = db
+        self.max_size = max_size
+        self.grace = grace
+        os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def file_ref(data):
+        return hashlib.sha256(data).hexdigest()
+
+    def file_path(self, ref):
+        """returns path of stored file, files are split into subdirectories
+        by first 2 characters of ref"""
+        return os.path.join(self.path, ref[:2], ref)
+
+    def put(self, data, stats=None):
+        """stores bytes-like data if it is not stored yet, returns ref
+        stats of the file are cached in db"""
+        ref = self.file_ref(data)
+        #the file is registered before it is looked up, so it cannot be
+        #evicted after it was found (see evict)
+        self.__register(ref, len(data), stats)
+        if os.path.exists(self.file_path(ref)):
+            return ref
+        os.makedirs(os.path.dirname(self.file_path(ref)), exist_ok=True)
+        #written to temporary file and renamed so readers never see
+        #partial file
+        tmp_fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.file_path(ref)))
+        try:
+            with os.fdopen(tmp_fd, 'wb') as tmp_file:
+                tmp_file.write(data)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+        self.__store(ref, tmp_path)
+        return ref
+
+    def spool_file(self, max_size=None):
+        """returns new temporary file of the store (SpoolFile)
+        to be moved to the store with put_spooled"""
+        return SpoolFile(self.path, max_size)
+
+    def spool(self, stream, max_size=None, chunk_size=64*1024):
+        """copies file-like stream to temporary file of the store
+        by chunks, so memory use does not depend on the file size
+        returns ref of the content and path of the temporary file
+        raises FileStoreException if the stream is longer than max_size"""
+        spool = self.spool_file(max_size)
+        try:
+            with spool:
+                while True:
+                    chunk = stream.read(chunk_size)
+                    if not chunk:
+                        break
+                    spool.write(chunk)
+                    if spool.too_large:
+                        raise FileStoreException('file is larger than ' + str(max_size) +\
+                            ' bytes')
+        except Exception:
+            os.unlink(spool.path)
+            raise
+        logging.debug('file store: ' + str(spool.size) + ' bytes spooled')
+        return spool.ref, spool.path
+
+    def put_spooled(self, ref, tmp_path, stats=None):
+        """moves temporary file (spool) with content of ref to the store,
+        the file is dropped if the content is stored already; returns ref"""
+        self.__register(ref, os.path.getsize(tmp_path), stats)
+        self.__store(ref, tmp_path)
+        return ref
+
+    def __store(self, ref, tmp_path):
+        """moves temporary file of registered ref to the store"""
+        path = self.file_path(ref)
+        if os.path.exists(path):
+            os.unlink(tmp_path)
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+        if self.max_size:
+            self.evict()
+
+    def __register(self, ref, size, stats):
+        """adds the file to the files table or marks it as recently used"""
+        if not self.db:
+            return
+        self.db.execute("""
+            insert into files (file_hash, size, stats)
+            values (%(file_hash)s, %(size)s, %(stats)s)
+            on conflict (file_hash) do update
+            set last_used = now(), stats = coalesce(excluded.stats, files.stats)""",\
+            {'file_hash': ref, 'size': size,\
+            'stats': json.dumps(stats, default=json_encode_extra) if stats else None})
+
+    def stats(self, ref):
+        """returns cached stats of stored file or None if the file
+        is not stored or its stats are unknown"""
+        if not self.db:
+            return None
+        res = self.db.query("""
+            update files set last_used = now()
+            where file_hash = %(file_hash)s
+            returning stats""", {'file_hash': ref})
+        if not res or not os.path.exists(self.file_path(ref)):
+            return None
+        return res.scalar()
+
+    def open(self, ref):
+        """returns read-only mmap of stored file (bytes for empty file),
+        raises FileNotFoundError if there is no such file"""
+        return map_file(self.file_path(ref))
+
+    def acquire(self, ref):
+        """adds reference to the file, referenced files are not evicted;
+        references are kept only by store with db
+        returns False if the file is not stored (eg it was evicted)"""
+        if self.db and not self.db.query("""
+            update files set refs = refs + 1, last_used = now()
+            where file_hash = %(file_hash)s
+            returning file_hash""", {'file_hash': ref}):
+            return False
+        if not os.path.exists(self.file_path(ref)):
+            self.release(ref)
+            return False
+        return True
+
+    def release(self, ref):
+        if not self.db:
+            return
+        self.db.execute("""
+            update files set refs = greatest(refs - 1, 0), last_used = now()
+            where file_hash = %(file_hash)s""", {'file_hash': ref})
+
+    def reset_refs(self):
+        """drops references of uploads interrupted by upload server restart"""
+        if not self.db:
+            return
+        self.db.execute('update files set refs = 0 where refs > 0')
+
+    def evict(self):
+        """deletes least recently used files which are not referenced
+        until the store fits in max_size, returns list of deleted refs;
+        refs and last_used are checked again on the deleted rows, so the file
+        registered or acquired concurrently is kept; the file registered
+        after its row was deleted waits for the transaction which unlinks it
+        and then is stored again"""
+        if not self.db or not self.max_size:
+            return []
+        with self.db.transaction():
+            evicted = self.db.query("""
+                delete from files
+                where file_hash in
+                    (select file_hash
+                    from
+                        (select file_hash, refs, last_used,
+                            sum(size) over (order by last_used desc, file_hash) as total
+                        from files) as lru
+                    where total > %(max_size)s and refs = 0 and
+                        last_used < now() - %(grace)s * interval '1 second') and
+                    refs = 0 and last_used < now() - %(grace)s * interval '1 second'
+                returning file_hash""", {'max_size': self.max_size, 'grace': self.grace})
+            refs = [row.file_hash for row in evicted]
+            for ref in refs:
+                try:
+                    #workers which have the file mapped keep reading it
+                    os.unlink(self.file_path(ref))
+                except FileNotFoundError:
+                    pass
+        if not refs:
+            return []
+        logging.debug('file store: ' + str(len(refs)) + ' files evicted')
+        return refs
@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+#coding=utf-8
+"""applies versioned sql migrations from migrations directory
+migration files are named <version>_<name>.sql and applied in version order,
+each one in its own transaction; applied versions are stored
+in schema_migrations table"""
+import logging
+import os
+import re
+
+from db import DBConn
+from conf import CONF, APP_ROOT
+
+MIGRATIONS_PATH = os.path.join(os.path.dirname(APP_ROOT), 'migrations')
+MIGRATION_FILE_RE = re.compile(r'^(\d+)_(\w+)\.sql$')
+MIGRATIONS_LOCK = 1823
+
+def list_migrations(path=MIGRATIONS_PATH):
+    """returns list of (version, name, file path) sorted by version"""
+    migrations = []
+    for file_name in os.listdir(path):
+        match = MIGRATION_FILE_RE.match(file_name)
+        if match:
+            migrations.append((int(match.group(1)), match.group(2),\
+                os.path.join(path, file_name)))
+    return sorted(migrations)
+
+def applied_versions(db):
+    db.execute("""
+        create table if not exists schema_migrations (
+            version integer primary key,
+            name character varying(64) not null,
+            applied timestamp without time zone default now())""")
+    return db.execute('select version from schema_migrations', keys=True) or []
+
+def migrate(db, path=MIGRATIONS_PATH):
+    """applies migrations not applied yet
+    returns list of applied versions"""
+    applied = applied_versions(db)
+    res = []
+    for version, name, file_path in list_migrations(path):
+        if version in applied:
+            continue
+        with open(file_path, 'r') as sql_file:
+            sql = sql_file.read()
+        with db.connection() as conn, conn.cursor() as cur:
+            try:
+                cur.execute('select pg_advisory_xact_lock(%s)', (MIGRATIONS_LOCK,))
+                cur.execute('select 1 from schema_migrations where version = %s', (version,))
+                if cur.fetchone():
+                    conn.rollback()
+                    continue
+                logging.info('applying migration ' + str(version) + ' ' + name)
+                cur.execute(sql)
+                cur.execute('insert into schema_migrations (version, name) values (%s, %s)',\
+                    (version, name))
+                conn.commit()
+                res.append(version)
+            except Exception:
+                conn.rollback()
+                logging.exception('Migration ' + str(version) + ' ' + name + ' failed')
+                raise
+    return res
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    DB = DBConn(CONF.items('db'))
+    DB.connect()
+    for applied_version in migrate(DB):
+        print('applied migration ' + str(applied_version))
@@ -2,20 +2,58 @@
 #coding=utf-8
 """onedif backend"""
 import logging
+import os
 import time
+import base64
+import binascii
+import csv
+import functools
+import io
 
-from flask import Flask, request, jsonify
+from flask import Flask, Request, Response, request, jsonify
+import simplejson as json
 from werkzeug.exceptions import InternalServerError
 
-from validator import validate, bad_request
-from db import DBConn, splice_params
+from validator import validate, bad_request, get_request_data, USER_CACHE
+from db import DBConn, DBPoolTimeout, splice_params
 from conf import CONF, APP_NAME, start_logging
+from json_utils import json_encode_extra
 from secret import get_secret, create_token
 import send_email
 from elog import ELog
-from upload_srv import upload_client
+from upload_srv import upload_client, UploadProcess
+from upload_status import open_status_table, status_watcher
+from file_store import FileStore, FileStoreException, map_file
+import adif
+from compression import DecompressMiddleware, compress_response
+
+class APIRequest(Request):
+    """files of multipart raw upload form are written by the form parser
+    directly to file store spools instead of werkzeug temporary files;
+    spools which were not moved to the store are removed with the request"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.spools = []
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None,\
+        content_length=None):
+        if self.endpoint != 'upload_raw':
+            return super()._get_file_stream(total_content_length, content_type,\
+                filename=filename, content_length=content_length)
+        spool = FILE_STORE.spool_file(\
+            max_size=CONF.getint('files', 'upload_max_size', fallback=None))
+        self.spools.append(spool)
+        return spool
+
+    def close(self):
+        super().close()
+        for spool in self.spools:
+            if os.path.exists(spool.path):
+                os.unlink(spool.path)
 
 APP = Flask(APP_NAME)
+APP.request_class = APIRequest
 APP.config.update(CONF['flask'])
 APP.secret_key = get_secret(CONF['files']['secret'])
 
@@ -24,9 +62,22 @@ with APP.app_context():
 logging.debug('starting in debug mode')
 
 DB = DBConn(CONF.items('db'))
-DB.connect()
+DB.connect(minconn=CONF.getint('db_pool', 'minconn', fallback=None),\
+    maxconn=CONF.getint('db_pool', 'maxconn', fallback=None))
 DB.verbose = True
+DB.pool_timeout = CONF.getint('db_pool', 'timeout', fallback=10)
 APP.db = DB
+#connection is checked out on the first query of the request
+APP.before_request(functools.partial(DB.checkout, lazy=True))
+APP.teardown_request(DB.release)
+
+APP.wsgi_app = DecompressMiddleware(APP.wsgi_app,\
+    max_size=CONF.getint('web', 'max_request_size', fallback=256 * 1024 * 1024))
+APP.after_request(functools.partial(compress_response,\
+    min_size=CONF.getint('web', 'compress_min_size', fallback=1024)))
+
+FILE_STORE = FileStore(CONF['files']['store'], db=DB,\
+    max_size=CONF.getint('files', 'store_max_size', fallback=None))
 
 def _create_token(data):
     return create_token(data, APP.secret_key)
@@ -39,6 +90,14 @@ def internal_error(exception):
     logging.exception(exception)
     return response
 
+@APP.errorhandler(DBPoolTimeout)
+def db_pool_timeout(exception):
+    'All db connections are busy; the client should retry later'
+    response = jsonify({'message': 'Сервер перегружен. Попробуйте позже.\n' +\
+        'Server is busy. Please try again later.'})
+    response.status_code = 503
+    return response
+
 @APP.route('/api/test', methods=['GET', 'POST'])
 def test():
     """test if api is up"""
@@ -53,7 +112,10 @@ def register_user():
     if user_exists:
         return bad_request('Пользователь с этим именем уже зарегистрирован.\n' +\
                 'This username is already exists.')
-    return send_user_data(user_data, create=True)
+    response = send_user_data(user_data, create=True)
+    #the login may be cached as unknown
+    USER_CACHE.invalidate()
+    return response
 
 @APP.route('/api/login', methods=['POST'])
 @validate(request_schema='login')
@@ -131,7 +193,7 @@ def account():
             logging.exception(req_data['elog'] + ' login error')
         account_data = splice_params(req_data, 'login_data')
         account_data['status'] = status
-        if not DB.param_upsert('accounts', account_key, account_data):
+        if not DB.upsert('accounts', account_key, account_data):
             raise Exception('Account update or creation failed')
         return jsonify({'status': status})
     else:
@@ -143,26 +205,195 @@ def account():
 @validate(request_schema='upload', token_schema='auth', login=True)
 def upload():
     req_data = request.get_json()
-    uploads = {}
-    for upload_data in req_data['uploads']:        
-        account_id = upload_data['account_id']
-        if DB.get_object('accounts', {'account_id': account_id, 'login': req_data['login']},\
-            create=False):
-            with upload_client() as conn:
-                conn.send(('upload', (account_id, req_data['file'], upload_data['params'])))
-                uploads[account_id] = conn.recv()
+    try:
+        file_data = base64.b64decode(req_data['file']['file'].split(',', 1)[-1], validate=True)
+        #the same file is parsed once, its stats are cached by the file store
+        file_stats = FILE_STORE.stats(FILE_STORE.file_ref(file_data))
+        if not file_stats:
+            file_stats = json.loads(json.dumps(adif.stats(file_data), default=json_encode_extra))
+    except binascii.Error:
+        return bad_request('Некорректный файл.\n' + 'Invalid file.')
+    except adif.AdifException as exc:
+        return adif_error(exc)
+    #the file is stored once and passed to the upload server by reference
+    file = {key: value for key, value in req_data['file'].items() if key != 'file'}
+    file['ref'] = FILE_STORE.put(file_data, file_stats)
+    file['stats'] = file_stats
+    return submit_uploads(req_data, file)
 
+@APP.route('/api/upload/raw', methods=['POST'])
+@validate(request_schema='upload_raw', token_schema='auth', login=True)
+def upload_raw():
+    """upload of adif file sent as raw request body with json metadata
+    (token, login, file name, uploads) in X-Upload-Metadata header
+    or as file field of multipart form with metadata field;
+    the file is streamed to the file store without base64 and json decoding"""
+    req_data = get_request_data()
+    if request.mimetype == 'multipart/form-data':
+        #the file was spooled by the form parser (APIRequest)
+        if 'file' not in request.files:
+            return bad_request('Файл не загружен.\n' + 'No file uploaded.')
+        spool = request.files['file'].stream
+        spool.close()
+        if spool.too_large:
+            return bad_request('Файл слишком большой.\n' + 'The file is too large.')
+        ref, tmp_path = spool.ref, spool.path
+    else:
+        try:
+            ref, tmp_path = FILE_STORE.spool(request.stream,\
+                max_size=CONF.getint('files', 'upload_max_size', fallback=None))
+        except FileStoreException:
+            return bad_request('Файл слишком большой.\n' + 'The file is too large.')
+    try:
+        file_stats = FILE_STORE.stats(ref)
+        if not file_stats:
+            buf = map_file(tmp_path)
+            try:
+                file_stats = json.loads(json.dumps(adif.stats(buf), default=json_encode_extra))
+            finally:
+                if hasattr(buf, 'close'):
+                    buf.close()
+        FILE_STORE.put_spooled(ref, tmp_path, file_stats)
+    except adif.AdifException as exc:
+        return adif_error(exc)
+    finally:
+        #spool is left if the file was not stored
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+    file = {'name': req_data['file']['name'], 'ref': ref, 'stats': file_stats}
+    return submit_uploads(req_data, file)
+
+def adif_error(exc):
+    return bad_request('Некорректный файл ADIF: ' + str(exc) + '\n' +\
+        'Invalid ADIF file: ' + str(exc))
+
+def submit_uploads(req_data, file):
+    """queues uploads of stored file to user's accounts
+    returns upload ids by account ids"""
+    targets = [[upload_data['account_id'], upload_data['params']]\
+        for upload_data in req_data['uploads']\
+        if DB.get_object('accounts',\
+            {'account_id': upload_data['account_id'], 'login': req_data['login']},\
+            create=False)]
+    uploads = {}
+    if targets:
+        upload_ids = upload_client().call('upload_many', file, targets)
+        uploads = {target[0]: upload_id for target, upload_id in zip(targets, upload_ids)}
+    if uploads and not any(uploads.values()):
+        response = jsonify({'message': 'Сервер загрузок перегружен. Попробуйте позже.\n' +\
+            'Upload server is busy. Please try again later.'})
+        response.status_code = 503
+        return response
     return jsonify(uploads)
 
+@APP.route('/api/upload_status/<int:upload_id>', methods=['GET'])
+def upload_status(upload_id):
+    """returns state code and progress (percents) of upload;
+    active uploads are read from upload server status table,
+    finished ones from db"""
+    status_table = open_status_table(CONF['files']['upload_status'])
+    status = status_table.find(upload_id) if status_table else None
+    if status:
+        return jsonify({'state': status['state'], 'progress': status['progress']})
+    state = DB.get_object('uploads', {'upload_id': upload_id}, create=False)
+    if not state:
+        return bad_request('Загрузка не найдена.\n' +\
+                'Upload not found')
+    state = state['state'] or 'init'
+    return jsonify({'state': UploadProcess.STATES[state],\
+        'progress': 100 if state == 'success' else 0})
+
+UPLOADS_EVENTS_KEEPALIVE = 15
+UPLOADS_EVENTS_LONG_POLL = 25
+
+@APP.route('/api/uploads_events', methods=['GET', 'POST'])
+@validate(token_schema='auth', login=True)
+def uploads_events():
+    """streams state and progress changes of user's uploads as server-sent
+    events; if 'poll' param (last received version cursor) is present waits for
+    the changes and returns them as json (long poll)"""
+    req_data = get_request_data()
+    #db connection used by validation is not held while waiting
+    DB.release()
+    watcher = status_watcher(CONF['files']['upload_status'])
+    if not watcher:
+        raise Exception('Upload status table is not available.')
+    login = req_data['login']
+    if 'poll' in req_data:
+        version, uploads = watcher.wait(login, watcher.cursor_version(req_data['poll']),\
+            timeout=UPLOADS_EVENTS_LONG_POLL)
+        return jsonify({'version': watcher.cursor(version), 'uploads': uploads})
+    since = watcher.cursor_version(request.headers.get('Last-Event-ID',\
+        req_data.get('since', 0)))
+
+    def events(version):
+        while True:
+            version, uploads = watcher.wait(login, version, timeout=UPLOADS_EVENTS_KEEPALIVE)
+            if uploads:
+                yield 'id: ' + watcher.cursor(version) + '\nevent: uploads\ndata: ' +\
+                    json.dumps(uploads) + '\n\n'
+            else:
+                yield ': keepalive\n\n'
+
+    return Response(events(since), mimetype='text/event-stream',\
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @APP.route('/api/uploads_list', methods=['POST'])
 @validate(token_schema='auth', login=True)
 def uploads_list():
     req_data = request.get_json()
-    uploads = DB.execute("""
-        select upload_id, elog, login_data, state
+    uploads = DB.query("""
+        select upload_id, elog, login_data, state,
+            qso_count, qso_date_from, qso_date_to, bands, modes
         from uploads join accounts on uploads.account_id = accounts.account_id
-        where accounts.login = %(login)s""", req_data, keys=True)
-    return jsonify(uploads)
+        where accounts.login = %(login)s""", {'login': req_data['login']})
+    if uploads is False:
+        raise Exception('Uploads list query failed.')
+    return Response(json.dumps(uploads.all(), default=json_encode_extra),\
+        mimetype='application/json')
+
+EXPORT_FIELDS = ['upload_id', 'elog', 'login_data', 'state', 'start', 'finish']
+
+def export_jsonl(chunks):
+    for chunk in chunks:
+        yield ''.join([json.dumps(row, default=json_encode_extra) + '\n' for row in chunk])
+
+def export_csv(chunks):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(EXPORT_FIELDS)
+    for chunk in chunks:
+        for row in chunk:
+            row['login_data'] = json.dumps(row['login_data'])
+            writer.writerow([row[field] for field in EXPORT_FIELDS])
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    yield buf.getvalue()
+
+EXPORT_FORMATS = {
+    'jsonl': (export_jsonl, 'application/x-ndjson'),
+    'csv': (export_csv, 'text/csv')
+    }
+
+@APP.route('/api/uploads_list/export', methods=['POST'])
+@validate(token_schema='auth', login=True)
+def uploads_list_export():
+    """streams uploads history as json lines or csv"""
+    req_data = request.get_json()
+    export_format = req_data.get('format', 'jsonl')
+    if export_format not in EXPORT_FORMATS:
+        return bad_request('Неизвестный формат.\n' +\
+                'Unknown export format.')
+    chunks = DB.iterate("""
+        select upload_id, elog, login_data, state, start, finish
+        from uploads join accounts on uploads.account_id = accounts.account_id
+        where accounts.login = %(login)s
+        order by upload_id""", {'login': req_data['login']})
+    export, mimetype = EXPORT_FORMATS[export_format]
+    return Response(export(chunks), mimetype=mimetype,\
+        headers={'Content-Disposition':\
+            'attachment; filename="uploads.' + export_format + '"'})
 
 @APP.route('/api/uploads_list', methods=['DELETE'])
 @validate(request_schema='upload_cancel', token_schema='auth', login=True)
@@ -185,10 +416,21 @@ def upload_cancel():
     if DB.execute("""select upload_id
         from uploads join accounts on uploads.account_id = accounts.account_id
         where upload_id = %(upload_id)s and login = %(login)s""", req_data):
-        with upload_client() as conn:
-            conn.send(('cancel', req_data['upload_id']))
-            rsp = conn.recv()
-            return jsonify(rsp)
+        return jsonify(upload_client().call('cancel', req_data['upload_id']))
+    else:
+        return bad_request('Загрузка не найдена.\n' +\
+                'Upload not found')
+
+@APP.route('/api/upload/resume', methods=['POST'])
+@validate(request_schema='upload_cancel', token_schema='auth', login=True)
+def upload_resume():
+    """resumes failed or interrupted upload, qsos acknowledged by the elog
+    are not sent again"""
+    req_data = request.get_json()
+    if DB.execute("""select upload_id
+        from uploads join accounts on uploads.account_id = accounts.account_id
+        where upload_id = %(upload_id)s and login = %(login)s""", req_data):
+        return jsonify(upload_client().call('resume', req_data['upload_id']))
     else:
         return bad_request('Загрузка не найдена.\n' +\
                 'Upload not found')
@@ -0,0 +1,208 @@
+#!/usr/bin/python3
+#coding=utf-8
+"""asyncio engine of upload server: accepts connections on unix socket
+without blocking, runs all uploads as tasks of a single process.
+Speaks the same protocol as upload_srv.serve_forever: json messages
+framed as by multiprocessing.connection so upload_client() works with
+both engines.
+Enabled by [upload_srv] engine = asyncio"""
+import asyncio
+import concurrent.futures
+import functools
+import logging
+import os
+import signal
+import struct
+
+import simplejson as json
+
+import upload_srv
+from upload_srv import DB, UploadProcess, UPLOAD_FINISHED_STATES, new_qsos,\
+    save_part, resumable_upload
+from conf import CONF
+from upload_status import StatusTable
+from file_store import FileStore
+
+HEADER = struct.Struct('!i')
+LONG_HEADER = struct.Struct('!Q')
+
+async def recv(reader):
+    """reads message framed as by multiprocessing.connection.Connection.send_bytes"""
+    size, = HEADER.unpack(await reader.readexactly(HEADER.size))
+    if size == -1:
+        size, = LONG_HEADER.unpack(await reader.readexactly(LONG_HEADER.size))
+    return json.loads(await reader.readexactly(size))
+
+def send(writer, obj):
+    data = json.dumps(obj).encode()
+    if len(data) > 0x7fffffff:
+        writer.write(HEADER.pack(-1) + LONG_HEADER.pack(len(data)))
+    else:
+        writer.write(HEADER.pack(len(data)))
+    writer.write(data)
+
+class AsyncUploadServer():
+    """runs up to max_uploads uploads concurrently, admits
+    max_uploads + queue_size unfinished ones"""
+
+    def __init__(self, max_uploads, queue_size):
+        self.__running = asyncio.Semaphore(max_uploads)
+        self.__capacity = max_uploads + queue_size
+        self.__tasks = {}
+        self.__states = {}
+        #db calls are blocking; single thread keeps state updates ordered
+        self.__db_executor = concurrent.futures.ThreadPoolExecutor(1)
+        self.__loop = asyncio.get_running_loop()
+
+    def __db(self, func, *args):
+        return self.__loop.run_in_executor(self.__db_executor, func, *args)
+
+    def report(self, upload_id, state):
+        self.__states[upload_id] = state
+        self.__db(DB.param_update, 'uploads', {'upload_id': upload_id}, {'state': state})
+        logging.debug('upload ' + str(upload_id) + ' state: ' + state)
+
+    def report_part(self, upload_id, account_id, fps):
+        self.__db(save_part, upload_id, account_id, fps)
+
+    async def __run(self, upload_process):
+        try:
+            async with self.__running:
+                await upload_process.run_async(self.report, self.report_part)
+        except asyncio.CancelledError:
+            #cancelled while waiting for its turn
+            upload_process.state = 'cancelled'
+            self.report(upload_process.upload_id, 'cancelled')
+        finally:
+            del self.__tasks[upload_process.upload_id]
+            if upload_process.status_slot is not None:
+                upload_srv.STATUS_TABLE.free(upload_process.status_slot)
+            if upload_process.file.get('ref'):
+                self.__db(upload_srv.FILE_STORE.release, upload_process.file['ref'])
+
+    async def submit(self, account_id, file, params, upload_id=None):
+        """creates upload (or resumes upload_id) and starts its task
+        returns upload id or None if the server is full"""
+        if len(self.__tasks) >= self.__capacity:
+            logging.warning('upload rejected: upload server is full')
+            return None
+        #fingerprinting of the file parses all of it: it runs in the default
+        #executor so it blocks neither the loop nor the db thread
+        file = await self.__loop.run_in_executor(None, new_qsos, account_id, file)
+        upload_process = await self.__db(functools.partial(UploadProcess,\
+            account_id, file, params, upload_id=upload_id))
+        upload_id = upload_process.upload_id
+        self.__states[upload_id] = 'init'
+        self.__tasks[upload_id] = asyncio.create_task(self.__run(upload_process))
+        return upload_id
+
+    async def submit_many(self, file, targets):
+        """creates uploads of the file to [account_id, params] targets
+        returns list of upload ids (None for rejected or failed uploads);
+        error of one target does not stop uploads to the other ones"""
+        upload_ids = []
+        for account_id, params in targets:
+            try:
+                upload_ids.append(await self.submit(account_id, file, params))
+            except Exception:
+                logging.exception('Upload to account ' + str(account_id) + ' failed')
+                upload_ids.append(None)
+        return upload_ids
+
+    async def resume(self, upload_id):
+        """resumes failed or interrupted upload
+        returns error message or None if the upload was started"""
+        if upload_id in self.__tasks:
+            return 'Upload is running'
+        error, upload = await self.__db(resumable_upload, upload_id)
+        if error:
+            return error
+        if await self.submit(*upload, upload_id=upload_id) is None:
+            return 'Upload server is busy'
+        return None
+
+    def cancel(self, upload_id):
+        """returns error message or None if the upload was cancelled"""
+        if upload_id not in self.__states:
+            return 'Upload not found'
+        if upload_id not in self.__tasks or\
+            self.__states[upload_id] in UPLOAD_FINISHED_STATES:
+            return 'Upload cannot be cancelled'
+        self.__tasks[upload_id].cancel()
+        return None
+
+    async def run_command(self, cmd, args):
+        """runs upload server command, returns its result"""
+        if cmd == 'upload':
+            return await self.submit(*args)
+        if cmd == 'upload_many':
+            return await self.submit_many(*args)
+        if cmd == 'cancel':
+            error = self.cancel(*args)
+            return error if error else 'ok'
+        if cmd == 'resume':
+            error = await self.resume(*args)
+            return error if error else 'ok'
+        if cmd == 'test':
+            return args
+        raise ValueError('Unknown command: ' + str(cmd))
+
+    async def handle_request(self, request, writer):
+        try:
+            response = {'id': request['id'],\
+                'result': await self.run_command(request['cmd'], request['args'])}
+        except Exception:
+            logging.exception('Command error')
+            response = {'id': request['id'], 'error': 'Command failed'}
+        try:
+            send(writer, response)
+            await writer.drain()
+        except ConnectionError:
+            logging.debug('Connection closed before response was sent')
+
+    async def handle_connection(self, reader, writer):
+        """serves persistent client connection; every request runs in its
+        own task, so responses may come in any order"""
+        logging.debug('Connection received')
+        requests = set()
+        try:
+            while True:
+                task = asyncio.create_task(self.handle_request(await recv(reader), writer))
+                requests.add(task)
+                task.add_done_callback(requests.discard)
+        except asyncio.IncompleteReadError:
+            logging.debug('Connection closed by client')
+        except asyncio.CancelledError:
+            logging.debug('Connection closed on server stop')
+        except Exception:
+            logging.exception('Connection handler error')
+        finally:
+            if requests:
+                await asyncio.wait(requests)
+            writer.close()
+
+async def serve(address):
+    logging.info('Starting asyncio server')
+    upload_srv.STATUS_TABLE = StatusTable(CONF['files']['upload_status'],\
+        slots=CONF.getint('upload_srv', 'status_slots', fallback=1024), create=True)
+    upload_srv.FILE_STORE = FileStore(CONF['files']['store'], db=DB,\
+        max_size=CONF.getint('files', 'store_max_size', fallback=None))
+    upload_srv.FILE_STORE.reset_refs()
+    server = AsyncUploadServer(\
+        CONF.getint('upload_srv', 'async_uploads', fallback=256),\
+        CONF.getint('upload_srv', 'queue', fallback=64))
+    if os.path.exists(address):
+        os.unlink(address)
+    unix_server = await asyncio.start_unix_server(server.handle_connection, address)
+    stop = asyncio.get_running_loop().create_future()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set_result, None)
+    async with unix_server:
+        await stop
+    logging.debug('Term signal')
+
+def serve_forever(address):
+    try:
+        asyncio.run(serve(address))
+    except Exception as exc:
+        logging.exception('Stopping server')
+        raise exc
@@ -4,21 +4,42 @@
 import multiprocessing
 from multiprocessing.connection import Listener, Client
 import threading
+import itertools
 import logging
+import os
 import time
 import uuid
 import socket
 import signal
 import sys
+import functools
+import bisect
+import collections
+import queue
+import asyncio
 from asyncio import CancelledError
+from concurrent.futures import Future
+
+import simplejson as json
 
 from db import DBConn
 from conf import CONF, start_logging
-from elog import ELog
+from elog import ELog, ELogException, SessionCache, Base64Content
+from upload_status import StatusTable
+from file_store import FileStore, FileStoreException
+import adif
 
 UPLOAD_PROCESSES = {}
+UPLOAD_FINISHED_STATES = ['login failed', 'upload failed', 'success', 'cancelled',\
+    'internal error']
+STATUS_TABLE = None
+FILE_STORE = None
+UPLOAD_POOL = None
+#logged in elog sessions of the process (each upload worker has its own)
+ELOG_SESSIONS = SessionCache(ttl=CONF.getint('upload_srv', 'session_ttl', fallback=600))
 DB = DBConn(CONF.items('db'))
-DB.connect()
+DB.connect(minconn=CONF.getint('db_pool', 'minconn', fallback=None),\
+    maxconn=CONF.getint('db_pool', 'maxconn', fallback=None))
 DB.verbose = True
 
 class PipeListener(threading.Thread):
@@ -27,32 +48,112 @@ class PipeListener(threading.Thread):
         threading.Thread.__init__(self)
         self.__pipe = pipe
         self.__callback = callback
+        self.__send_lock = threading.Lock()
 
     def run(self):
-        while True:
-            data = self.__pipe.recv()
-            self.__callback(data)
+        try:
+            while True:
+                data = self.__pipe.recv()
+                self.__callback(data)
+        except (EOFError, OSError):
+            logging.debug('Pipe closed')
+        self.on_close()
+
+    def on_close(self):
+        """called when the other end of the pipe is closed"""
+        pass
 
     def send(self, data):
-        self.__pipe.send(data)
+        with self.__send_lock:
+            self.__pipe.send(data)
 
-class UploadConnector(PipeListener):
+class WorkerConnector(PipeListener):
+    """receives uploads states from upload worker process,
+    reports the pool when the worker exits"""
 
-    def __init__(self, pipe, upload_process):
-        self.upload_id = upload_process.upload_id
-        self.__upload_process = upload_process
+    def __init__(self, pipe, pool, worker):
+        self.__pool = pool
+        self.worker = worker
+        #ids of uploads sent to the worker and not finished yet
+        self.jobs = set()
         super().__init__(pipe, self.on_pipe_data)
+        self.daemon = True
 
-    def on_pipe_data(self, state):
-        up_record = UPLOAD_PROCESSES[self.upload_id]
-        up_record['state'] = state
-        up_record['time'] = time.time()
-        if state in ['login failed', 'upload failed', 'success', 'cancelled']:
-            self.__upload_process.join()
-        DB.param_update('uploads', {'upload_id': self.upload_id}, {'state': state})
-        logging.debug('upload ' + str(self.upload_id) + ' state: ' + state)
+    def on_pipe_data(self, data):
+        if data[0] == 'part':
+            self.__pool.on_upload_part(*data[1:])
+        else:
+            upload_id, state = data
+            self.__pool.on_upload_state(upload_id, state)
+
+    def on_close(self):
+        self.__pool.on_worker_exit(self)
+
+@functools.lru_cache(16)
+def file_fingerprints(ref):
+    """fingerprints of stored file's records (adif.fingerprints);
+    stored files never change, so results are cached by ref"""
+    buf = FILE_STORE.open(ref)
+    try:
+        return adif.fingerprints(buf)
+    finally:
+        if hasattr(buf, 'close'):
+            buf.close()
 
-class UploadProcess(multiprocessing.Process):
+def new_qsos(account_id, file):
+    """returns file entry with qsos of the file which were not uploaded
+    to the account yet (new_qsos is their number);
+    file passed by value is returned as is"""
+    if 'ref' not in file or not file['ref']:
+        return file
+    fps, starts, ends = file_fingerprints(file['ref'])
+    uploaded = DB.query("""
+        select fp from qso_fingerprints
+        where account_id = %(account_id)s and fp = any(%(fps)s)""",\
+        {'account_id': account_id, 'fps': list(fps)})
+    if uploaded is False:
+        raise Exception('Qso fingerprints query failed.')
+    uploaded = {row.fp for row in uploaded}
+    if not uploaded:
+        return dict(file, new_qsos=len(fps))
+    new = [idx for idx, fp in enumerate(fps) if fp not in uploaded]
+    logging.debug(str(len(fps) - len(new)) + ' qsos of ' + str(len(fps)) +\
+        ' were uploaded to account ' + str(account_id) + ' before')
+    if not new:
+        return dict(file, ref=None, new_qsos=0)
+    buf = FILE_STORE.open(file['ref'])
+    try:
+        data = b'\n'.join([buf[starts[idx]:ends[idx]] for idx in new])
+    finally:
+        if hasattr(buf, 'close'):
+            buf.close()
+    return dict(file, ref=FILE_STORE.put(data), new_qsos=len(new))
+
+def save_part(upload_id, account_id, fps):
+    """stores fingerprints of qsos of the part of upload acknowledged
+    by the elog, so they are not sent again (eg on resume)"""
+    if DB.bulk_insert('qso_fingerprints',\
+        [{'account_id': account_id, 'fp': fp} for fp in fps],\
+        on_conflict='on conflict do nothing') is False:
+        logging.error('upload ' + str(upload_id) + ': part save failed')
+
+def resumable_upload(upload_id):
+    """returns error message (or None) and account_id, file, params
+    of the upload to resume"""
+    upload = DB.get_object('uploads', {'upload_id': upload_id}, create=False)
+    if not upload:
+        return 'Upload not found', None
+    #the file of the upload could be evicted from the store
+    if upload['state'] == 'success' or not upload['file_ref'] or\
+        not os.path.exists(FILE_STORE.file_path(upload['file_ref'])):
+        return 'Upload cannot be resumed', None
+    return None, (upload['account_id'],\
+        {'name': upload['file_name'], 'ref': upload['file_ref']},\
+        upload['params'] or {})
+
+class UploadProcess():
+    """upload job: created by upload server, pickled to the pipe of a worker
+    and run by one of upload worker threads"""
     STATES = {\
             'init': 0,\
             'login': 1,\
@@ -63,37 +164,61 @@ class UploadProcess(multiprocessing.Process):
             'cancelled': 6,\
             'internal error': 7}
 
-    def __init__(self, pipe, account_id, file, params):
+    def __init__(self, account_id, file, params, upload_id=None):
+        """upload_id is set when failed or interrupted upload is resumed"""
         logging.debug('upload process init start')
-        logging.debug('upload process super init call')
-        multiprocessing.Process.__init__(self)
-        account = DB.get_object('accounts', {'account_id': account_id})
+        file_columns = {'file_ref': file.get('ref'), 'file_name': file.get('name'),\
+            'params': json.dumps(params)}
+        with DB.transaction():
+            account = DB.get_object('accounts', {'account_id': account_id}, create=False)
+            if upload_id:
+                DB.param_update('uploads', {'upload_id': upload_id},\
+                    dict(file_columns, state='init'))
+                upload_rec = {'upload_id': upload_id}
+            else:
+                upload_rec = DB.get_object('uploads',\
+                    dict(self.stats_columns(file.get('stats')), account_id=account_id,\
+                        **file_columns), create=True)
+            #the file is not evicted from the store while the upload is running
+            if file.get('ref') and not FILE_STORE.acquire(file['ref']):
+                raise FileStoreException('File ' + file['ref'] + ' is not stored')
+        self.account_id = account_id
         self.elog_type = account['elog']
         self.login_data = account['login_data']
-        upload_rec = DB.get_object('uploads', {'account_id': account_id}, create=True)
         logging.debug('upload db record created')
         logging.debug(upload_rec)
         self.upload_id = upload_rec['upload_id']
         logging.debug('upload id: ' + str(self.upload_id))
         self.file = file
         self.params = params
-        self.status_file_path = CONF['web']['root'] + '/uploads/' + str(self.upload_id)
+        self.status_slot = STATUS_TABLE.allocate(self.upload_id, account['login'])
+        if self.status_slot is None:
+            logging.warning('upload ' + str(self.upload_id) + ': status table is full')
         self.__progress = 0
         self.__state = 'init'
-        self.__pipe = pipe
         self.__export_status()
-        logging.debug('upload process status file init')
-        self.__cancel_event = threading.Event()
+        logging.debug('upload process status slot init')
+        self.__cancel_event = None
+        self.__report = None
+        self.__report_part = None
+        self.__fingerprints = None
         logging.debug('upload process init completed')
 
-    def on_pipe_data(self, data):
-        if data == 'cancel':
-            self.__cancel_event.set()
+    @staticmethod
+    def stats_columns(stats):
+        """uploads table columns of file statistics (adif.stats)"""
+        if not stats:
+            return {}
+        return {'qso_count': stats['qso_count'],\
+            'qso_date_from': stats['date_from'],\
+            'qso_date_to': stats['date_to'],\
+            'bands': json.dumps(stats['bands']),\
+            'modes': json.dumps(stats['modes'])}
 
     def __export_status(self):
-        with open(self.status_file_path, 'wb') as status_file:
-            status_bytes = [UploadProcess.STATES[self.state], int(round(self.progress, 2)*100)]
-            status_file.write(bytearray(status_bytes))
+        if self.status_slot is not None:
+            STATUS_TABLE.update(self.status_slot,\
+                UploadProcess.STATES[self.state], int(round(self.progress, 2)*100))
 
     @property
     def state(self):
@@ -106,6 +231,8 @@ class UploadProcess(multiprocessing.Process):
             logging.debug(self.state)
             self.__state = value
             self.__export_status()
+            if self.__report and value != 'init':
+                self.__report(self.upload_id, value)
 
     @property
     def progress(self):
@@ -121,82 +248,528 @@ class UploadProcess(multiprocessing.Process):
         if self.__cancel_event.is_set():
             raise CancelledError('The upload was cancelled')
 
+    def open_file(self):
+        """returns file entry for elog upload; file passed by ref is mapped
+        from the file store and encoded to base64 while it is sent"""
+        if 'ref' not in self.file:
+            return self.file
+        file = {key: value for key, value in self.file.items()\
+            if key not in ('ref', 'stats', 'new_qsos')}
+        file['file'] = Base64Content(FILE_STORE.open(self.file['ref']), prefix=',')
+        return file
+
+    def split_file(self, file, elog):
+        """returns list of file entries of the parts of the file
+        split by its elog type limits (ELog.types)"""
+        limits = ELog.types.get(self.elog_type, {})
+        max_records = limits.get('maxRecords')
+        max_bytes = limits.get('maxBytes')
+        content = file['file']
+        if not isinstance(content, Base64Content) or not (max_records or max_bytes):
+            return [file]
+        if max_bytes:
+            #maxBytes limits the request body: adif bytes of the part
+            #encoded to base64 have to fit in it along with the request json
+            max_bytes = max((max_bytes - len(content.prefix) -\
+                elog.upload_envelope_size(file, self.params)) // 4 * 3, 1)
+        qso_count = self.file.get('new_qsos', self.file.get('stats', {}).get('qso_count'))
+        if (not max_bytes or len(content.buf) <= max_bytes) and\
+            (not max_records or (qso_count is not None and qso_count <= max_records)):
+            return [file]
+        parts = adif.split(content.buf, max_records, max_bytes)
+        logging.debug('upload ' + str(self.upload_id) + ' is split into ' +\
+            str(len(parts)) + ' parts')
+        return [dict(file, file=Base64Content(content.buf, ',', start, end))\
+            for start, end in parts]
+
+    @staticmethod
+    def close_file(file):
+        if file and isinstance(file['file'], Base64Content):
+            file['file'].close()
+
+    def part_uploaded(self, part):
+        """reports fingerprints of qsos of the part of stored file
+        acknowledged by the elog"""
+        content = part['file']
+        if not self.__report_part or not isinstance(content, Base64Content):
+            return
+        fps, starts, _ = self.__fingerprints or file_fingerprints(self.file['ref'])
+        part_fps = fps[bisect.bisect_left(starts, content.start):\
+            bisect.bisect_left(starts, content.end)]
+        self.__report_part(self.upload_id, self.account_id, part_fps)
+
     def upload_callback(self, progress):
         logging.debug('upload ' + str(self.upload_id) + ' progress:')
         logging.debug(progress)
         self.progress = progress
 
-    def run(self):
+    def run(self, cancel_event, report, report_part=None):
+        """runs the upload; report(upload_id, state) is called on every
+        state change, report_part(upload_id, account_id, fingerprints)
+        on every part acknowledged by the elog"""
+        self.__cancel_event = cancel_event
+        self.__report = report
+        self.__report_part = report_part
+        session_key = (self.account_id, self.elog_type)
+        file = None
         try:
             logging.debug('upload ' + str(self.upload_id) + ' start')
-            pipe_listener = PipeListener(self.__pipe, self.on_pipe_data)
-            pipe_listener.start()
+            if self.file.get('new_qsos') == 0:
+                logging.debug('upload ' + str(self.upload_id) + ': no new qsos')
+                self.state = 'success'
+                return
+            file = self.open_file()
             self.state = 'login'
-            elog = ELog(self.elog_type)
             self.__raise_for_cancel()
-            if elog.login(self.login_data):
-                self.__raise_for_cancel()
-                self.state = 'upload'
-                if elog.upload(self.file, self.params, callback=self.upload_callback,\
-                    cancel_event=self.__cancel_event):
-                    self.state = 'success'
-                else:
-                    self.state = 'upload failed'
-            else:
-                self.state = 'login failed'
+            elog = ELOG_SESSIONS.get(session_key, self.elog_type, self.login_data)
+            self.__raise_for_cancel()
+            self.state = 'upload'
+            files = self.split_file(file, elog)
+            max_parts = ELog.types.get(self.elog_type, {}).get('maxParts', 1)
+            results, auth_failed = elog.upload_many(files, self.params,\
+                callback=self.upload_callback, cancel_event=self.__cancel_event,\
+                max_parts=max_parts, file_uploaded=self.part_uploaded)
+            if auth_failed:
+                logging.debug('upload ' + str(self.upload_id) + ': session expired, relogin')
+                ELOG_SESSIONS.invalidate(session_key)
+                elog = ELOG_SESSIONS.get(session_key, self.elog_type, self.login_data)
+                results, _ = elog.upload_many([part for part, result in zip(files, results)\
+                        if not result], self.params, callback=self.upload_callback,\
+                    cancel_event=self.__cancel_event, max_parts=max_parts,\
+                    file_uploaded=self.part_uploaded)
+            self.state = 'success' if all(results) else 'upload failed'
+        except ELogException:
+            self.state = 'login failed'
         except CancelledError:
             self.state = 'cancelled'
         except Exception:
             self.state = 'internal error'
             logging.exception('Upload thread error')
         finally:
-            self.__pipe.send(self.state)
+            self.close_file(file)
 
-def conn_worker(conn, _up=UPLOAD_PROCESSES):
-    logging.debug('Connection received')
-    data = conn.recv()
-    if data[0] == 'upload':
-        logging.debug('start upload')
-        pipe_process, pipe_connector = multiprocessing.Pipe()
-        logging.debug('pipes created')
-        upload_process = UploadProcess(pipe_process, *data[1])
+    async def run_async(self, report, report_part=None):
+        """runs the upload in asyncio upload server engine;
+        the upload is cancelled by cancellation of the task running it"""
+        self.__report = report
+        self.__report_part = report_part
+        session_key = (self.account_id, self.elog_type)
+        file = None
+        try:
+            logging.debug('upload ' + str(self.upload_id) + ' start')
+            if self.file.get('new_qsos') == 0:
+                logging.debug('upload ' + str(self.upload_id) + ': no new qsos')
+                self.state = 'success'
+                return
+            file = self.open_file()
+            self.state = 'login'
+            elog = await ELOG_SESSIONS.get_async(session_key, self.elog_type, self.login_data)
+            self.state = 'upload'
+            #parsing of the file does not run on the event loop
+            loop = asyncio.get_running_loop()
+            files = await loop.run_in_executor(None, self.split_file, file, elog)
+            if self.__report_part and self.file.get('ref'):
+                self.__fingerprints = await loop.run_in_executor(None,\
+                    file_fingerprints, self.file['ref'])
+            max_parts = ELog.types.get(self.elog_type, {}).get('maxParts', 1)
+            results, auth_failed = await elog.upload_many_async(files, self.params,\
+                callback=self.upload_callback, max_parts=max_parts,\
+                file_uploaded=self.part_uploaded)
+            if auth_failed:
+                logging.debug('upload ' + str(self.upload_id) + ': session expired, relogin')
+                ELOG_SESSIONS.invalidate(session_key)
+                elog = await ELOG_SESSIONS.get_async(session_key, self.elog_type,\
+                    self.login_data)
+                results, _ = await elog.upload_many_async([part for part, result\
+                        in zip(files, results) if not result], self.params,\
+                    callback=self.upload_callback, max_parts=max_parts,\
+                    file_uploaded=self.part_uploaded)
+            self.state = 'success' if all(results) else 'upload failed'
+        except ELogException:
+            self.state = 'login failed'
+        except CancelledError:
+            self.state = 'cancelled'
+        except Exception:
+            self.state = 'internal error'
+            logging.exception('Upload task error')
+        finally:
+            self.close_file(file)
+
+class UploadWorker(multiprocessing.Process):
+    """upload worker process, runs up to threads uploads at once
+    taking them from its pipe"""
+
+    def __init__(self, pipe, threads):
+        multiprocessing.Process.__init__(self)
+        self.daemon = True
+        self.__pipe = pipe
+        self.__threads = threads
+        self.__jobs = None
+        self.__running = {}
+        self.__pipe_listener = None
+
+    def on_pipe_data(self, data):
+        if data[0] == 'job':
+            self.__running[data[1].upload_id] = threading.Event()
+            self.__jobs.put(data[1])
+        elif data[0] == 'cancel' and data[1] in self.__running:
+            self.__running[data[1]].set()
+
+    def report(self, upload_id, state):
+        self.__pipe_listener.send((upload_id, state))
+
+    def report_part(self, upload_id, account_id, fps):
+        self.__pipe_listener.send(('part', upload_id, account_id, fps))
+
+    def run_jobs(self):
+        while True:
+            upload_process = self.__jobs.get()
+            try:
+                upload_process.run(self.__running[upload_process.upload_id], self.report,\
+                    self.report_part)
+            finally:
+                del self.__running[upload_process.upload_id]
+
+    def run(self):
+        self.__jobs = queue.Queue()
+        self.__pipe_listener = PipeListener(self.__pipe, self.on_pipe_data)
+        self.__pipe_listener.daemon = True
+        self.__pipe_listener.start()
+        threads = [threading.Thread(target=self.run_jobs) for _ in range(self.__threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+class UploadPool():
+    """fixed set of upload worker processes; jobs wait in the pool queue
+    until one of the workers has an idle thread and are sent to the worker
+    over its own pipe, so the worker holds no lock shared with others;
+    uploads are admitted while the number of unfinished ones is less than
+    workers * threads + queue_size;
+    worker which exited is replaced, uploads sent to it fail"""
+
+    def __init__(self, workers, threads, queue_size, _up=UPLOAD_PROCESSES):
+        self.__up = _up
+        self.__queue = collections.deque()
+        self.__threads = threads
+        self.__admission = threading.BoundedSemaphore(workers * threads + queue_size)
+        self.__lock = threading.RLock()
+        #worker started by one thread must not inherit the pipe
+        #of the worker started by another
+        self.__start_lock = threading.Lock()
+        self.__closed = False
+        self.__connectors = [self.__start_worker() for _ in range(workers)]
+        logging.debug('upload pool started: ' + str(workers) + ' workers, ' +\
+            str(threads) + ' threads each')
+
+    def __start_worker(self):
+        """starts upload worker process, returns its connector"""
+        with self.__start_lock:
+            pipe_worker, pipe_connector = multiprocessing.Pipe()
+            worker = UploadWorker(pipe_worker, self.__threads)
+            worker.start()
+            #the worker holds the only copy of its end of the pipe,
+            #so the connector gets EOF when the worker exits
+            pipe_worker.close()
+        connector = WorkerConnector(pipe_connector, self, worker)
+        connector.start()
+        return connector
+
+    def __dispatch(self):
+        """sends queued jobs to the workers with idle threads"""
+        with self.__lock:
+            while self.__queue and self.__connectors:
+                connector = min(self.__connectors, key=lambda item: len(item.jobs))
+                if len(connector.jobs) >= self.__threads:
+                    return
+                upload_process = self.__queue.popleft()
+                upload_id = upload_process.upload_id
+                up_record = self.__up[upload_id]
+                up_record['connector'] = connector
+                connector.jobs.add(upload_id)
+                try:
+                    connector.send(('job', upload_process))
+                    if up_record['cancel']:
+                        connector.send(('cancel', upload_id))
+                except OSError:
+                    #the worker exited, its jobs are failed by on_worker_exit
+                    logging.exception('upload ' + str(upload_id) +\
+                        ': worker ' + str(connector.worker.pid) + ' is not available')
+
+    def on_worker_exit(self, connector):
+        """fails uploads sent to the exited worker and starts a new one"""
+        connector.worker.join()
+        if self.__closed:
+            return
+        logging.error('upload worker ' + str(connector.worker.pid) +\
+            ' exited with code ' + str(connector.worker.exitcode))
+        new_connector = self.__start_worker()
+        with self.__lock:
+            self.__connectors[self.__connectors.index(connector)] = new_connector
+            failed = list(connector.jobs)
+        for upload_id in failed:
+            up_record = self.__up[upload_id]
+            if up_record['state'] not in UPLOAD_FINISHED_STATES:
+                if up_record['status_slot'] is not None:
+                    STATUS_TABLE.update(up_record['status_slot'],\
+                        UploadProcess.STATES['internal error'], 0)
+                self.on_upload_state(upload_id, 'internal error')
+        self.__dispatch()
+
+    def close(self):
+        """stops worker processes"""
+        self.__closed = True
+        for connector in self.__connectors:
+            connector.worker.terminate()
+        for connector in self.__connectors:
+            connector.join()
+
+    def submit(self, account_id, file, params, upload_id=None):
+        """creates upload (or resumes upload_id) and queues it
+        returns upload id or None if the pool is full"""
+        if not self.__admission.acquire(blocking=False):
+            logging.warning('upload rejected: upload pool is full')
+            return None
+        try:
+            file = new_qsos(account_id, file)
+            upload_process = UploadProcess(account_id, file, params, upload_id=upload_id)
+        except Exception:
+            self.__admission.release()
+            raise
         logging.debug('upload process created, id: ' + str(upload_process.upload_id))
-        upload_connector = UploadConnector(pipe_connector, upload_process)
-        logging.debug('upload connector created')
-        _up[upload_process.upload_id] = {\
-            'connector': upload_connector,\
+        self.__up[upload_process.upload_id] = {\
+            'connector': None,\
+            'cancel': False,\
+            'status_slot': upload_process.status_slot,\
+            'file_ref': upload_process.file.get('ref'),\
             'state': 'init'}
-        upload_process.start()
-        upload_connector.start()
-        logging.debug('upload process started')
-        conn.send(upload_process.upload_id)
-        logging.debug('id sent to client')
-    elif data[0] == 'cancel':
-        upload_id = data[1]
-        error = None
-        if upload_id in _up:
-            upload = _up[upload_id]
-            if upload['state'] in ['init', 'login', 'upload']:
-                upload['connector'].send('cancel')
-            else:
-                error = 'Upload cannot be cancelled'
-        else:
-            error = 'Upload not found'
-        conn.send(error if error else 'ok')
-    elif data[0] == 'test':
-        conn.send(data)
-    conn.close()
+        with self.__lock:
+            self.__queue.append(upload_process)
+        self.__dispatch()
+        return upload_process.upload_id
+
+    def submit_many(self, file, targets):
+        """creates uploads of the file to [account_id, params] targets
+        returns list of upload ids (None for rejected or failed uploads);
+        error of one target does not stop uploads to the other ones"""
+        upload_ids = []
+        for account_id, params in targets:
+            try:
+                upload_ids.append(self.submit(account_id, file, params))
+            except Exception:
+                logging.exception('Upload to account ' + str(account_id) + ' failed')
+                upload_ids.append(None)
+        return upload_ids
+
+    def resume(self, upload_id):
+        """resumes failed or interrupted upload: qsos of the parts which were
+        not acknowledged by the elog are sent again
+        returns error message or None if the upload was queued"""
+        if upload_id in self.__up and\
+            self.__up[upload_id]['state'] not in UPLOAD_FINISHED_STATES:
+            return 'Upload is running'
+        error, upload = resumable_upload(upload_id)
+        if error:
+            return error
+        if self.submit(*upload, upload_id=upload_id) is None:
+            return 'Upload server is busy'
+        return None
+
+    def cancel(self, upload_id):
+        """returns error message or None if cancel was requested"""
+        if upload_id not in self.__up:
+            return 'Upload not found'
+        upload = self.__up[upload_id]
+        if upload['state'] not in ['init', 'login', 'upload']:
+            return 'Upload cannot be cancelled'
+        #queued upload is cancelled by its worker when it is dispatched
+        with self.__lock:
+            upload['cancel'] = True
+            connector = upload['connector']
+        if connector:
+            try:
+                connector.send(('cancel', upload_id))
+            except OSError:
+                logging.exception('upload ' + str(upload_id) + ': cancel was not sent')
+        return None
+
+    def on_upload_state(self, upload_id, state):
+        up_record = self.__up[upload_id]
+        up_record['state'] = state
+        up_record['time'] = time.time()
+        DB.param_update('uploads', {'upload_id': upload_id}, {'state': state})
+        if state in UPLOAD_FINISHED_STATES:
+            if up_record['status_slot'] is not None:
+                STATUS_TABLE.free(up_record['status_slot'])
+            if up_record['file_ref']:
+                FILE_STORE.release(up_record['file_ref'])
+            self.__admission.release()
+            if up_record['connector']:
+                with self.__lock:
+                    up_record['connector'].jobs.discard(upload_id)
+                self.__dispatch()
+        logging.debug('upload ' + str(upload_id) + ' state: ' + state)
+
+    def on_upload_part(self, upload_id, account_id, fps):
+        save_part(upload_id, account_id, fps)
+        logging.debug('upload ' + str(upload_id) + ': part of ' + str(len(fps)) +\
+            ' qsos acknowledged')
+
+def send_message(conn, message):
+    """sends message as length-prefixed json (framed by
+    multiprocessing.connection)"""
+    conn.send_bytes(json.dumps(message).encode())
+
+def recv_message(conn):
+    return json.loads(conn.recv_bytes())
+
+def run_command(cmd, args):
+    """runs upload server command, returns its result"""
+    if cmd == 'upload':
+        logging.debug('start upload')
+        return UPLOAD_POOL.submit(*args)
+    if cmd == 'upload_many':
+        logging.debug('start uploads')
+        return UPLOAD_POOL.submit_many(*args)
+    if cmd == 'cancel':
+        error = UPLOAD_POOL.cancel(*args)
+        return error if error else 'ok'
+    if cmd == 'resume':
+        error = UPLOAD_POOL.resume(*args)
+        return error if error else 'ok'
+    if cmd == 'test':
+        return args
+    raise ValueError('Unknown command: ' + str(cmd))
+
+def conn_worker(conn):
+    """serves persistent client connection: requests are answered in
+    the order they were received, the response carries request id"""
+    logging.debug('Connection received')
+    try:
+        while True:
+            request = recv_message(conn)
+            DB.checkout()
+            try:
+                response = {'id': request['id'],\
+                    'result': run_command(request['cmd'], request['args'])}
+            except Exception:
+                logging.exception('Command error')
+                response = {'id': request['id'], 'error': 'Command failed'}
+            finally:
+                DB.release()
+            send_message(conn, response)
+    except EOFError:
+        logging.debug('Connection closed by client')
+    finally:
+        conn.close()
 
 def __sigterm(signum, frame):
     logging.debug('Term signal')
     sys.exit(0)
 
-def upload_client():
-    return Client(CONF['files']['upload_server_socket'], 'AF_UNIX')
+class UploadClientError(Exception):
+    """upload server failed to run the command or connection was lost"""
+    pass
+
+class UploadClient():
+    """persistent connections to the upload server shared by threads
+    of the process; requests carry ids, so several requests can be sent
+    over a connection before their responses are received"""
+
+    def __init__(self, address, connections=2, timeout=30):
+        self.address = address
+        self.timeout = timeout
+        self.__conns = [None] * connections
+        self.__next_conn = itertools.cycle(range(connections))
+        self.__ids = itertools.count(1)
+        self.__pending = {}
+        self.__lock = threading.Lock()
+        self.__send_locks = [threading.Lock() for _ in range(connections)]
+
+    def __connect(self, idx):
+        conn = Client(self.address, 'AF_UNIX')
+        self.__conns[idx] = conn
+        reader = threading.Thread(target=self.__read, args=(conn,))
+        reader.daemon = True
+        reader.start()
+        return conn
+
+    def __read(self, conn):
+        try:
+            while True:
+                response = recv_message(conn)
+                with self.__lock:
+                    _, future = self.__pending.pop(response['id'], (None, None))
+                if not future:
+                    continue
+                if 'error' in response:
+                    future.set_exception(UploadClientError(response['error']))
+                else:
+                    future.set_result(response['result'])
+        except (EOFError, OSError):
+            logging.debug('Upload server connection closed')
+        with self.__lock:
+            if conn in self.__conns:
+                self.__conns[self.__conns.index(conn)] = None
+            lost = [req_id for req_id, (req_conn, _) in self.__pending.items()\
+                if req_conn is conn]
+            futures = [self.__pending.pop(req_id)[1] for req_id in lost]
+        for future in futures:
+            future.set_exception(UploadClientError('Upload server connection lost'))
+        conn.close()
+
+    def request(self, cmd, *args):
+        """sends command, returns future of its result"""
+        future = Future()
+        with self.__lock:
+            req_id = next(self.__ids)
+            idx = next(self.__next_conn)
+        with self.__send_locks[idx]:
+            #connection left by restarted server fails on first send,
+            #the request is resent once over the new one
+            for attempt in range(2):
+                with self.__lock:
+                    conn = self.__conns[idx] or self.__connect(idx)
+                    self.__pending[req_id] = (conn, future)
+                try:
+                    send_message(conn, {'id': req_id, 'cmd': cmd, 'args': args})
+                    break
+                except OSError:
+                    with self.__lock:
+                        del self.__pending[req_id]
+                        if self.__conns[idx] is conn:
+                            self.__conns[idx] = None
+                    conn.close()
+                    if attempt:
+                        raise
+        return future
+
+    def call(self, cmd, *args):
+        """sends command and waits for its result"""
+        return self.request(cmd, *args).result(self.timeout)
+
+def upload_client(_clients={}, _lock=threading.Lock()):
+    """returns upload server client of the process"""
+    with _lock:
+        if not _clients:
+            _clients['client'] = UploadClient(CONF['files']['upload_server_socket'],\
+                connections=CONF.getint('upload_srv', 'client_connections', fallback=2))
+    return _clients['client']
 
 def serve_forever(address, family):
+    global STATUS_TABLE, FILE_STORE, UPLOAD_POOL
     try:
         logging.info('Starting server')
+        STATUS_TABLE = StatusTable(CONF['files']['upload_status'],\
+            slots=CONF.getint('upload_srv', 'status_slots', fallback=1024), create=True)
+        FILE_STORE = FileStore(CONF['files']['store'], db=DB,\
+            max_size=CONF.getint('files', 'store_max_size', fallback=None))
+        FILE_STORE.reset_refs()
+        UPLOAD_POOL = UploadPool(\
+            CONF.getint('upload_srv', 'workers', fallback=os.cpu_count()),\
+            CONF.getint('upload_srv', 'threads', fallback=4),\
+            CONF.getint('upload_srv', 'queue', fallback=64))
         signal.signal(signal.SIGTERM, __sigterm)
         with Listener(address, family) as listener:
             listener._listener._socket.settimeout(0.1)
@@ -215,4 +788,8 @@ def serve_forever(address, family):
 
 if __name__ == "__main__":
     start_logging('upload_srv', CONF['logs']['upload_srv_level'])
-    serve_forever(CONF['files']['upload_server_socket'], 'AF_UNIX')
+    if CONF.get('upload_srv', 'engine', fallback=None) == 'asyncio':
+        import upload_async
+        upload_async.serve_forever(CONF['files']['upload_server_socket'])
+    else:
+        serve_forever(CONF['files']['upload_server_socket'], 'AF_UNIX')
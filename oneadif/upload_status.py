@@ -0,0 +1,240 @@
+#!/usr/bin/python3
+#coding=utf-8
+"""fixed-size memory-mapped table of uploads status
+the table is created by upload server and shared with upload processes
+(written) and api (read). Every slot has a single writer at a time:
+upload server when the slot is allocated, the upload process after that.
+Writers do not lock, readers detect torn reads by slot sequence number
+(seqlock) and retry.
+Slots of finished uploads keep their last status until they are reused,
+free slots are reused in the order they were freed. Resumed upload gets
+a new slot while the old one may still keep its last status, so of the slots
+of the same upload the one with the latest start is actual."""
+import collections
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+SEQ = struct.Struct('<I')
+#users.login is up to 16 characters, up to 4 bytes each in utf-8
+LOGIN_SIZE = 64
+#upload_id, state, progress, start, updated, login
+DATA = struct.Struct('<qBB2xdd' + str(LOGIN_SIZE) + 's')
+DATA_FIELDS = ('upload_id', 'state', 'progress', 'start', 'updated', 'login')
+SLOT_SIZE = SEQ.size + DATA.size
+UPLOAD_ID = struct.Struct('<q')
+#slot which is still written after that many reads is unreadable
+#(eg its writer died in the middle of the write)
+READ_RETRIES = 1000
+
+class StatusTable():
+
+    def __init__(self, path, slots=1024, create=False):
+        self.path = path
+        if create:
+            #existing table of the same size is cleared in place
+            #so api processes which have it mapped keep reading the actual one
+            if not os.path.exists(path) or os.path.getsize(path) != slots * SLOT_SIZE:
+                tmp_path = path + '.tmp'
+                with open(tmp_path, 'wb') as table_file:
+                    table_file.truncate(slots * SLOT_SIZE)
+                os.replace(tmp_path, path)
+        with open(path, 'r+b' if create else 'rb') as table_file:
+            self.__buf = mmap.mmap(table_file.fileno(), 0,\
+                access=mmap.ACCESS_WRITE if create else mmap.ACCESS_READ)
+            self.inode = os.fstat(table_file.fileno()).st_ino
+        self.slots = len(self.__buf) // SLOT_SIZE
+        if create:
+            self.__buf[:] = bytes(len(self.__buf))
+        self.__free = collections.deque(range(self.slots) if create else [])
+        self.__lock = threading.Lock()
+
+    def __write(self, slot, upload_id, state, progress, start, updated, login):
+        offset = slot * SLOT_SIZE
+        seq = SEQ.unpack_from(self.__buf, offset)[0]
+        #odd seq left by the writer which died in the middle of the write
+        #is not incremented, so the slot becomes readable after this write
+        seq = (seq + 1 | 1) & 0xffffffff
+        SEQ.pack_into(self.__buf, offset, seq)
+        DATA.pack_into(self.__buf, offset + SEQ.size,\
+            upload_id, state, progress, start, updated, login)
+        SEQ.pack_into(self.__buf, offset, (seq + 1) & 0xffffffff)
+
+    def seq(self, slot):
+        """returns slot sequence number, it changes on every slot write"""
+        return SEQ.unpack_from(self.__buf, slot * SLOT_SIZE)[0]
+
+    def read(self, slot):
+        """returns slot data dict or None if slot was never used
+        or it cannot be read (READ_RETRIES)"""
+        offset = slot * SLOT_SIZE
+        for _ in range(READ_RETRIES):
+            seq = SEQ.unpack_from(self.__buf, offset)[0]
+            if seq & 1:
+                continue
+            data = DATA.unpack_from(self.__buf, offset + SEQ.size)
+            if SEQ.unpack_from(self.__buf, offset)[0] == seq:
+                break
+        else:
+            logging.warning('upload status slot ' + str(slot) + ' is unreadable')
+            return None
+        if not data[0]:
+            return None
+        res = dict(zip(DATA_FIELDS, data))
+        res['login'] = res['login'].rstrip(b'\0').decode()
+        return res
+
+    def find(self, upload_id):
+        """returns data of upload's latest slot or None if upload
+        is not in the table"""
+        found = None
+        for slot in range(self.slots):
+            if UPLOAD_ID.unpack_from(self.__buf, slot * SLOT_SIZE + SEQ.size)[0] == upload_id:
+                data = self.read(slot)
+                if data and data['upload_id'] == upload_id and\
+                    (not found or data['start'] > found['start']):
+                    found = data
+        return found
+
+    def allocate(self, upload_id, login, state=0):
+        """takes free slot for upload, returns slot index or None
+        if the table is full"""
+        with self.__lock:
+            if not self.__free:
+                return None
+            slot = self.__free.popleft()
+        now = time.time()
+        #longer login is cut on character boundary
+        login = login.encode()[:LOGIN_SIZE].decode(errors='ignore').encode()
+        self.__write(slot, upload_id, state, 0, now, now, login)
+        return slot
+
+    def update(self, slot, state, progress):
+        """writes upload state and progress (percents) to its slot"""
+        data = DATA.unpack_from(self.__buf, slot * SLOT_SIZE + SEQ.size)
+        self.__write(slot, data[0], state, progress, data[3], time.time(), data[5])
+
+    def free(self, slot):
+        """returns slot of finished upload to the free list,
+        the slot keeps upload status until it is reused"""
+        with self.__lock:
+            self.__free.append(slot)
+
+    def close(self):
+        self.__buf.close()
+
+class StatusWatcher(threading.Thread):
+    """polls status table in a single thread and wakes up threads waiting
+    for status changes of their user's uploads, so the number of waiting
+    clients does not affect the polling cost.
+    Versions are counted by the watcher of every api process, clients get
+    them as cursors with watcher id, so the cursor issued by another process
+    is not mistaken for a version of this one"""
+
+    def __init__(self, table, interval=0.25):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.table = table
+        self.interval = interval
+        self.version = 0
+        self.id = os.urandom(4).hex()
+        self.__slots = {}
+        self.__logins = {}
+        self.__cond = threading.Condition()
+
+    def run(self):
+        seqs = [None] * self.table.slots
+        while True:
+            #the watcher serves all clients of the process,
+            #so it keeps polling whatever fails
+            try:
+                seqs = self.poll(seqs)
+            except Exception:
+                logging.exception('upload status table poll failed')
+            time.sleep(self.interval)
+
+    def poll(self, seqs):
+        """reads slots changed since seqs were taken, wakes up waiting
+        threads; returns current slots seqs"""
+        table = open_status_table(self.table.path)
+        if table and table.inode != self.table.inode:
+            #upload server created new table, all its slots are read
+            logging.debug('upload status table was replaced')
+            self.table = table
+            seqs = [None] * table.slots
+            with self.__cond:
+                self.__slots.clear()
+        changed = []
+        for slot in range(self.table.slots):
+            seq = self.table.seq(slot)
+            if seq != seqs[slot]:
+                seqs[slot] = seq
+                try:
+                    data = self.table.read(slot)
+                except Exception:
+                    logging.exception('upload status slot ' + str(slot) + ' read failed')
+                    continue
+                if data:
+                    changed.append((slot, data))
+        if changed:
+            with self.__cond:
+                self.version += 1
+                for slot, data in changed:
+                    data['version'] = self.version
+                    self.__slots[slot] = data
+                    self.__logins[data['login']] = self.version
+                self.__cond.notify_all()
+        return seqs
+
+    def cursor(self, version):
+        """returns cursor of version for clients"""
+        return self.id + '.' + str(version)
+
+    def cursor_version(self, cursor):
+        """returns version of cursor issued by this watcher or 0 for
+        unknown cursor (eg of other process), so the client gets
+        the current state of all its uploads"""
+        watcher_id, _, version = str(cursor).partition('.')
+        if watcher_id != self.id or not version.isdigit():
+            return 0
+        return min(int(version), self.version)
+
+    def wait(self, login, since=0, timeout=None):
+        """waits until uploads of login change after version since
+        returns current version and list of changed uploads data"""
+        with self.__cond:
+            self.__cond.wait_for(lambda: self.__logins.get(login, 0) > since, timeout)
+            latest = {}
+            for data in self.__slots.values():
+                if data['login'] == login and (data['upload_id'] not in latest or\
+                    data['start'] > latest[data['upload_id']]['start']):
+                    latest[data['upload_id']] = data
+            return self.version, [{key: data[key] for key in\
+                    ('upload_id', 'state', 'progress', 'start', 'updated')}\
+                for data in latest.values() if data['version'] > since]
+
+def open_status_table(path, _tables={}):
+    """opens status table created by upload server for reading,
+    the table is mapped once per process and mapped again when upload
+    server replaces it (eg with the table of other size)"""
+    try:
+        inode = os.stat(path).st_ino
+    except FileNotFoundError:
+        return None
+    if path not in _tables or _tables[path].inode != inode:
+        _tables[path] = StatusTable(path)
+    return _tables[path]
+
+def status_watcher(path, _watchers={}, _lock=threading.Lock()):
+    """returns running status watcher of the table (one per process)"""
+    with _lock:
+        if path not in _watchers:
+            table = open_status_table(path)
+            if not table:
+                return None
+            _watchers[path] = StatusWatcher(table)
+            _watchers[path].start()
+    return _watchers[path]
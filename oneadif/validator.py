@@ -1,8 +1,15 @@
 #!/usr/bin/python3
 #coding=utf-8
 """flask request object validation"""
+import fcntl
+import hashlib
 import logging
+import mmap
+import os
+import struct
+import threading
 import time
+from collections import OrderedDict
 from functools import wraps
 
 from flask import request, current_app, jsonify
@@ -52,12 +59,177 @@ def _json_validator(schemas_path):
 
     return _validate_dict
 
+def get_request_data():
+    """returns request json data or query string params for GET requests;
+    for file uploads sent as raw body or multipart form returns json metadata
+    of the upload (X-Upload-Metadata header or metadata form field);
+    raw body is not read, multipart form file is written to the file store
+    spool while the form is parsed (srv.APIRequest)"""
+    if request.method == 'GET':
+        return request.args.to_dict()
+    if not request.is_json:
+        metadata = request.headers.get('X-Upload-Metadata')
+        if not metadata and request.mimetype == 'multipart/form-data':
+            metadata = request.form.get('metadata')
+        if metadata:
+            try:
+                return json.loads(metadata)
+            except ValueError:
+                logging.error('Invalid upload metadata')
+                return None
+    return request.get_json()
+
 def decode_token(token):
     try:
         return jwt.decode(token, current_app.secret_key, algorithms=['HS256'])
     except jwt.exceptions.DecodeError:
         return None
 
+class TokenCache():
+    """lru cache of verified tokens: decoded claims (None if the token
+    is not valid) and results of their validation by token schemas.
+    Keys are digests of the secret and the token, so tokens are not kept
+    in memory and entries of the old secret are not used after its rotation.
+    Entries of expired tokens are dropped when they are hit."""
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def key(secret, token):
+        if not isinstance(secret, bytes):
+            secret = str(secret).encode()
+        return hashlib.sha256(secret + b'\0' + str(token).encode()).digest()
+
+    def get(self, key, schema):
+        """returns (claims, (validated, error)) or None if token
+        was not validated with the schema yet"""
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                return None
+            claims, results = entry
+            if claims and 'expires' in claims and claims['expires'] < time.time():
+                del self.__entries[key]
+                return None
+            self.__entries.move_to_end(key)
+            if schema not in results:
+                return None
+            return claims, results[schema]
+
+    def put(self, key, schema, claims, result):
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                entry = self.__entries[key] = (claims, {})
+                if len(self.__entries) > self.max_size:
+                    self.__entries.popitem(last=False)
+            entry[1][schema] = result
+
+TOKEN_CACHE = TokenCache(CONF.getint('web', 'token_cache_size', fallback=1024))
+
+def verify_token(token, schema, token_validator):
+    """returns token claims and result of their validation by token
+    schema (validated, error); verified tokens are cached, so repeated
+    requests with the same token skip signature and schema checks"""
+    key = TokenCache.key(current_app.secret_key, token)
+    cached = TOKEN_CACHE.get(key, schema)
+    if cached:
+        return cached
+    token_data = decode_token(token)
+    result = token_validator(token_data, schema)
+    TOKEN_CACHE.put(key, schema, token_data, result)
+    return token_data, result
+
+class UserCache():
+    """ttl cache of users existence, unknown logins are cached too
+    (for shorter negative_ttl). invalidate() has to be called when users
+    are registered or deleted; if generation_path is set invalidations
+    are shared by all processes which use the same file: it keeps
+    generation counter, the process drops its cache when the counter
+    changes"""
+    GENERATION = struct.Struct('<Q')
+
+    def __init__(self, ttl=60, negative_ttl=10, max_size=4096, generation_path=None):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self.__entries = {}
+        self.__lock = threading.Lock()
+        self.__generation = 0
+        self.__fd = None
+        self.__buf = None
+        if generation_path:
+            self.__fd = os.open(generation_path, os.O_RDWR | os.O_CREAT, 0o664)
+            if os.fstat(self.__fd).st_size < self.GENERATION.size:
+                os.ftruncate(self.__fd, self.GENERATION.size)
+            self.__buf = mmap.mmap(self.__fd, self.GENERATION.size)
+
+    def __sync(self):
+        """drops entries if cache was invalidated by another process,
+        returns current generation"""
+        with self.__lock:
+            if self.__buf:
+                generation = self.GENERATION.unpack_from(self.__buf)[0]
+                if generation != self.__generation:
+                    self.__entries.clear()
+                    self.__generation = generation
+            return self.__generation
+
+    def exists(self, login, lookup):
+        """returns True if user is registered; lookup(login) is called
+        on cache miss, it returns None on error (result is not cached)"""
+        generation = self.__sync()
+        now = time.monotonic()
+        with self.__lock:
+            entry = self.__entries.get(login)
+            if entry and entry[1] > now:
+                return entry[0]
+        exists = lookup(login)
+        if exists is None:
+            return False
+        with self.__lock:
+            #the result is dropped if cache was invalidated during lookup
+            if self.__generation == generation:
+                if len(self.__entries) >= self.max_size:
+                    for key in [key for key, entry in self.__entries.items()\
+                        if entry[1] <= now] or\
+                        [min(self.__entries, key=lambda key: self.__entries[key][1])]:
+                        del self.__entries[key]
+                self.__entries[login] = (exists,\
+                    now + (self.ttl if exists else self.negative_ttl))
+        return exists
+
+    def invalidate(self):
+        """drops cached users of all processes sharing the generation file"""
+        with self.__lock:
+            if self.__buf:
+                fcntl.lockf(self.__fd, fcntl.LOCK_EX)
+                try:
+                    generation = (self.GENERATION.unpack_from(self.__buf)[0] + 1) &\
+                        0xffffffffffffffff
+                    self.GENERATION.pack_into(self.__buf, 0, generation)
+                finally:
+                    fcntl.lockf(self.__fd, fcntl.LOCK_UN)
+            else:
+                generation = self.__generation + 1
+            self.__entries.clear()
+            self.__generation = generation
+
+USER_CACHE = UserCache(ttl=CONF.getint('web', 'user_cache_ttl', fallback=60),\
+    negative_ttl=CONF.getint('web', 'user_cache_negative_ttl', fallback=10),\
+    generation_path=CONF.get('files', 'user_cache', fallback=None))
+
+def lookup_user(login):
+    """returns True if user is registered, None on db error"""
+    res = current_app.db.query('select login from users where login = %(login)s',\
+        {'login': login}, prepare=('user_exists',))
+    if res is False:
+        return None
+    return bool(res)
+
 def validate(request_schema=None, token_schema=None, recaptcha_field=None, login=False):
     """validates flask request object by all relevant means
     returns true/false"""
@@ -69,7 +241,7 @@ def validate(request_schema=None, token_schema=None, recaptcha_field=None, login
 
         @wraps(func)
         def wrapped(*args, **kwargs):
-            request_data = request.get_json()
+            request_data = get_request_data()
             error_message = None
             if request_data:
                 if request_schema:
@@ -83,12 +255,12 @@ def validate(request_schema=None, token_schema=None, recaptcha_field=None, login
                             'Recaptcha check failed. Please try again.'
                 if token_schema:
                     if 'token' in request_data and request_data['token']:
-                        token_data = decode_token(request_data['token'])
+                        token_data, (validated, error) = verify_token(request_data['token'],\
+                            token_schema, token_validator)
                         logging.debug('token deciphered:')
                         logging.debug(token_data)
                         logging.debug('current time: ')
                         logging.debug(time.time())
-                        validated, error = token_validator(token_data, token_schema)
                         if not validated or\
                             ('expires' in token_data and token_data['expires'] < time.time()) or\
                             token_data['login'] != request_data['login']:
@@ -102,8 +274,7 @@ def validate(request_schema=None, token_schema=None, recaptcha_field=None, login
                             'No authentification data. ' +\
                             'Try relogin and/or repeat the operation.'
                 if login:
-                    user_data = current_app.db.get_object('users', {'login': request_data['login']}, create=None)
-                    if not user_data:
+                    if not USER_CACHE.exists(request_data['login'], lookup_user):
                         error_message = 'Пользователь не зарегистрирован.\n' +\
                             'The username is not registered.'
 
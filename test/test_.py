@@ -230,14 +230,14 @@ def test_upload():
     state = None
     progress = 0
     data = None
-    status_uri = CONF['web']['address'] + '/uploads/' + str(upload_id)
+    status_uri = API_URI + 'upload_status/' + str(upload_id)
     while state not in (2, 4, 5):
         try:
             status_rsp = requests.get(status_uri)
-            data = status_rsp.text
-            if len(data) > 1:
-                _state = ord(data[0])
-                _progress = ord(data[1])
+            data = status_rsp.json()
+            if data:
+                _state = data['state']
+                _progress = data['progress']
                 if state != _state:
                     state = _state
                     logging.debug('State: ' + str(state))
@@ -252,6 +252,36 @@ def test_upload():
         except Exception:
             logging.exception('bad upload status response')
 
+def test_upload_malformed():
+    upload_data = create_upload_data()
+    upload_data['token'] = _create_token({'login': upload_data['login'], 'type': 'auth'})
+    upload_data['file']['file'] = ',' + base64.b64encode(b'<CALL:4>R7CL<EOR><CALL:5>RK0UN').decode()
+    req = requests.post(API_URI + 'upload', json=upload_data)
+    logging.debug(req.text)
+    assert req.status_code == 400
+
+@pytest.mark.parametrize('multipart', [False, True])
+def test_upload_raw(multipart):
+    upload_data = create_upload_data()
+    upload_data['token'] = _create_token({'login': upload_data['login'], 'type': 'auth'})
+    file_data = base64.b64decode(upload_data['file'].pop('file')[1:])
+    metadata = json.dumps(upload_data)
+    if multipart:
+        req = requests.post(API_URI + 'upload/raw', data={'metadata': metadata},\
+            files={'file': (upload_data['file']['name'], file_data)})
+    else:
+        req = requests.post(API_URI + 'upload/raw', data=file_data,\
+            headers={'X-Upload-Metadata': metadata,\
+                'Content-Type': 'application/octet-stream'})
+    logging.debug(req.text)
+    req.raise_for_status()
+    upload_ids = req.json()
+    assert upload_ids[str(upload_data['uploads'][0]['account_id'])]
+    req = requests.post(API_URI + 'upload/raw', data=file_data,\
+        headers={'X-Upload-Metadata': json.dumps(dict(upload_data, token='')),\
+            'Content-Type': 'application/octet-stream'})
+    assert req.status_code == 400
+
 def test_uploads_list():
     def post(update_token=None, update_post=None, delete=False):
         token_data = {'login': LOGIN, 'type': 'auth'}
@@ -268,6 +298,7 @@ def test_uploads_list():
     req.raise_for_status()
     uploads = req.json()
     assert uploads
+    assert uploads[-1]['qso_count']
     uploads_ids = [x['upload_id'] for x in uploads]
     
     req = post(update_token={'login': LOGIN + '_'}, update_post={'login': LOGIN + '_'})
@@ -290,3 +321,50 @@ def test_uploads_list():
     uploads = post().json()
     assert uploads_ids[1] in [x['upload_id'] for x in uploads]
 
+
+def test_uploads_list_export():
+    post_data = {'login': LOGIN, 'token': _create_token({'login': LOGIN, 'type': 'auth'})}
+    uploads = requests.post(API_URI + 'uploads_list', json=post_data).json()
+
+    req = requests.post(API_URI + 'uploads_list/export', json=post_data, stream=True)
+    req.raise_for_status()
+    exported = [json.loads(line) for line in req.iter_lines() if line]
+    assert sorted([x['upload_id'] for x in exported]) ==\
+        sorted([x['upload_id'] for x in uploads])
+
+    post_data['format'] = 'csv'
+    req = requests.post(API_URI + 'uploads_list/export', json=post_data)
+    req.raise_for_status()
+    lines = req.text.splitlines()
+    assert lines[0].startswith('upload_id,')
+    assert len(lines) == len(uploads) + 1
+
+    post_data['format'] = 'xml'
+    req = requests.post(API_URI + 'uploads_list/export', json=post_data)
+    assert req.status_code == 400
+
+def test_uploads_events():
+    upload_data = create_upload_data()
+    upload_data['token'] = _create_token({'login': upload_data['login'], 'type': 'auth'})
+    req = requests.post(API_URI + 'upload', json=upload_data)
+    req.raise_for_status()
+    upload_ids = set(req.json().values())
+    auth = {'login': upload_data['login'], 'token': upload_data['token']}
+
+    #--long poll
+    req = requests.post(API_URI + 'uploads_events', json=dict(auth, poll=0))
+    req.raise_for_status()
+    rsp_data = req.json()
+    assert rsp_data['version']
+    assert upload_ids & set([x['upload_id'] for x in rsp_data['uploads']])
+
+    #--server-sent events
+    req = requests.get(API_URI + 'uploads_events', params=auth, stream=True)
+    req.raise_for_status()
+    assert req.headers['Content-Type'].startswith('text/event-stream')
+    for line in req.iter_lines(decode_unicode=True):
+        if line.startswith('data: '):
+            uploads = json.loads(line[6:])
+            assert upload_ids & set([x['upload_id'] for x in uploads])
+            break
+    req.close()
@@ -0,0 +1,63 @@
+#!/usr/bin/python3
+#coding=utf-8
+
+import pytest
+import sys
+from datetime import date
+
+sys.path.append('oneadif')
+from adif import records, stats, fingerprint, fingerprints, split, AdifException
+
+ADIF = b"""ADIF export <test>
+<ADIF_VER:5>3.1.0
+<EOH>
+<CALL:4>R7CL <QSO_DATE:8>20190512 <TIME_ON:4>1200 <BAND:3>20M <MODE:3>SSB <EOR>
+<call:5>RK0UN<qso_date:8>20190430<band:3>40m<mode:2:S>CW<eor>
+<CALL:5>RZ3DC <QSO_DATE:8:D>20190601 <BAND:3>20m <MODE:3>ssb <COMMENT:7>a <b> c <EOR>
+"""
+
+def test_records():
+    recs = list(records(ADIF))
+    assert len(recs) == 3
+    assert recs[0]['CALL'] == 'R7CL'
+    assert recs[1] == {'CALL': 'RK0UN', 'QSO_DATE': '20190430', 'BAND': '40m', 'MODE': 'CW'}
+    assert recs[2]['COMMENT'] == 'a <b> c'
+    assert list(records(memoryview(ADIF), fields={'CALL'}))[1] == {'CALL': 'RK0UN'}
+    assert list(records(b'<CALL:4>R7CL<EOR>')) == [{'CALL': 'R7CL'}]
+
+def test_stats():
+    assert stats(ADIF) == {'qso_count': 3,\
+        'date_from': date(2019, 4, 30),\
+        'date_to': date(2019, 6, 1),\
+        'bands': {'20m': 2, '40m': 1},\
+        'modes': {'SSB': 2, 'CW': 1}}
+
+@pytest.mark.parametrize('data', [
+    b'header without end',
+    b'<EOH>',
+    b'<CALL:4>R7CL<EOR><CALL:5>RK0UN',
+    b'<CALL:40>R7CL<EOR>',
+    b'<CALL:4>R7CL<EOR><CALL>',
+    b'<CALL:4>R7CL<QSO_DATE:6>190512<EOR>',
+    b'<CALL:4>R7CL<QSO_DATE:8>20191332<EOR>'])
+def test_malformed(data):
+    with pytest.raises(AdifException):
+        stats(data)
+
+def test_fingerprints():
+    fps, starts, ends = fingerprints(ADIF)
+    assert len(set(fps)) == 3
+    assert ADIF[starts[1]:ends[1]] == b'<call:5>RK0UN<qso_date:8>20190430<band:3>40m<mode:2:S>CW<eor>'
+    assert fingerprint({'CALL': 'r7cl ', 'QSO_DATE': '20190512', 'TIME_ON': '120059',\
+        'BAND': '20M', 'MODE': 'ssb'}) == fps[0]
+    assert fingerprint({'CALL': 'R7CL', 'QSO_DATE': '20190512', 'TIME_ON': '1201',\
+        'BAND': '20M', 'MODE': 'SSB'}) != fps[0]
+
+def test_split():
+    recs = [ADIF[start:end] for _, start, end in records(ADIF, spans=True)]
+    assert [ADIF[start:end] for start, end in split(ADIF)] == [ADIF[ADIF.index(recs[0]):].rstrip()]
+    parts = split(ADIF, max_records=2)
+    assert len(parts) == 2
+    assert ADIF[parts[1][0]:parts[1][1]] == recs[2]
+    assert [ADIF[start:end] for start, end in split(ADIF, max_bytes=len(recs[0]))] == recs
+    assert len(split(ADIF, max_bytes=1)) == 3
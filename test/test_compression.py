@@ -0,0 +1,65 @@
+#!/usr/bin/python3
+#coding=utf-8
+
+import pytest
+import functools
+import gzip
+import sys
+import zlib
+
+import simplejson as json
+from flask import Flask, Response, request, jsonify
+
+sys.path.append('oneadif')
+from compression import DecompressMiddleware, compress_response
+from elog import gzip_chunks
+
+@pytest.fixture
+def client():
+    app = Flask(__name__)
+    app.wsgi_app = DecompressMiddleware(app.wsgi_app, max_size=1024 * 1024)
+    app.after_request(functools.partial(compress_response, min_size=1024))
+
+    @app.route('/echo', methods=['POST'])
+    def echo():
+        return jsonify(request.get_json())
+
+    @app.route('/stream', methods=['GET'])
+    def stream():
+        return Response(b'x' * 1024 for _ in range(4))
+
+    return app.test_client()
+
+@pytest.mark.parametrize('encoding, compress', [
+    ('gzip', gzip.compress),
+    ('deflate', zlib.compress)])
+def test_request_decoding(client, encoding, compress):
+    data = {'adif': '<CALL:4>R7CL<EOR>' * 1000}
+    rsp = client.post('/echo', data=compress(json.dumps(data).encode()),\
+        content_type='application/json',\
+        headers={'Content-Encoding': encoding, 'Accept-Encoding': 'gzip'})
+    assert rsp.status_code == 200
+    assert rsp.headers['Content-Encoding'] == 'gzip'
+    assert json.loads(gzip.decompress(rsp.data)) == data
+
+def test_request_errors(client):
+    data = gzip.compress(b'{"adif": "' + b'0' * 2 * 1024 * 1024 + b'"}')
+    assert client.post('/echo', data=data, content_type='application/json',\
+        headers={'Content-Encoding': 'gzip'}).status_code == 413
+    assert client.post('/echo', data=data[:-16], content_type='application/json',\
+        headers={'Content-Encoding': 'gzip'}).status_code in (400, 413)
+    assert client.post('/echo', data=b'{}', content_type='application/json',\
+        headers={'Content-Encoding': 'br'}).status_code == 415
+
+def test_response_compression(client):
+    rsp = client.post('/echo', json={'a': 1}, headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in rsp.headers
+    rsp = client.post('/echo', json={'a': 'a' * 2048})
+    assert 'Content-Encoding' not in rsp.headers
+    rsp = client.get('/stream', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in rsp.headers
+    assert len(rsp.data) == 4096
+
+def test_gzip_chunks():
+    chunks = [b'<CALL:4>R7CL<EOR>' * 100, memoryview(b'<CALL:5>RK0UN<EOR>'), b'']
+    assert gzip.decompress(b''.join(gzip_chunks(chunks))) == b''.join(chunks)
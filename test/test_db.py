@@ -0,0 +1,353 @@
+#!/usr/bin/python3
+#coding=utf-8
+
+import pytest
+import logging
+import os
+import sys
+import threading
+import time
+
+sys.path.append('oneadif')
+from db import DBConn, DBPoolTimeout
+from conf import CONF
+from migrate import migrate
+from file_store import FileStore
+
+POOL_SIZE = 3
+
+DB = DBConn(CONF.items('db'))
+DB.verbose = True
+DB.connect(minconn=1, maxconn=POOL_SIZE)
+
+def test_pool_checkout():
+    pids = set()
+
+    def worker():
+        DB.checkout()
+        try:
+            pids.add(DB.execute('select pg_backend_pid() as pid, pg_sleep(0.2)')['pid'])
+        finally:
+            DB.release()
+
+    threads = [threading.Thread(target=worker) for _ in range(POOL_SIZE * 2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    logging.debug(pids)
+    assert len(pids) == POOL_SIZE
+
+def test_lazy_checkout():
+    DB.checkout(lazy=True)
+    try:
+        #connection taken by the first query is kept until release
+        pid = DB.execute('select pg_backend_pid()')
+        assert DB.execute('select pg_backend_pid()') == pid
+        with DB.transaction():
+            assert DB.execute('select pg_backend_pid()') == pid
+    finally:
+        DB.release()
+    idle = []
+
+    def worker():
+        DB.checkout(lazy=True)
+        try:
+            idle.append(True)
+            time.sleep(0.2)
+        finally:
+            DB.release()
+
+    threads = [threading.Thread(target=worker) for _ in range(POOL_SIZE * 2)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.05)
+    #lazily checked out threads do not hold the pool
+    pool_timeout = DB.pool_timeout
+    DB.pool_timeout = 0.1
+    try:
+        assert DB.execute('select 1') == 1
+    finally:
+        DB.pool_timeout = pool_timeout
+    for thread in threads:
+        thread.join()
+    assert len(idle) == POOL_SIZE * 2
+
+def test_pool_timeout():
+    held = threading.Event()
+    done = threading.Event()
+
+    def worker():
+        DB.checkout()
+        try:
+            held.wait()
+            done.wait()
+        finally:
+            DB.release()
+
+    threads = [threading.Thread(target=worker) for _ in range(POOL_SIZE)]
+    for thread in threads:
+        thread.start()
+    pool_timeout = DB.pool_timeout
+    DB.pool_timeout = 0.2
+    try:
+        held.set()
+        time.sleep(0.1)
+        started = time.time()
+        with pytest.raises(DBPoolTimeout):
+            DB.checkout()
+        assert time.time() - started < 1
+    finally:
+        DB.pool_timeout = pool_timeout
+        done.set()
+        for thread in threads:
+            thread.join()
+    assert DB.execute('select 1') == 1
+
+def test_pool_reconnect():
+    DB.checkout()
+    pid = DB.execute('select pg_backend_pid()')
+    DB.release()
+    admin_db = DBConn(CONF.items('db'))
+    admin_db.connect()
+    assert admin_db.execute('select pg_terminate_backend(%(pid)s)', {'pid': pid})
+    ping_interval = DB.ping_interval
+    DB.ping_interval = 0
+    try:
+        assert DB.execute('select 1') == 1
+    finally:
+        DB.ping_interval = ping_interval
+
+def test_bulk_insert():
+    users = [{'login': 'test_bulk_%04d' % idx, 'password': '11111111'}\
+        for idx in range(2500)]
+    DB.execute("delete from users where login like 'test\\_bulk\\_%'")
+    try:
+        assert DB.bulk_insert('users', users, page_size=1000) == len(users)
+        assert DB.bulk_insert('users', users[-10:] + [{'login': 'test_bulk_new', 'password': '1'}],\
+            on_conflict='on conflict do nothing') == 1
+        assert DB.execute("select count(*) from users where login like 'test\\_bulk\\_%'") ==\
+            len(users) + 1
+    finally:
+        DB.execute("delete from users where login like 'test\\_bulk\\_%'")
+
+def test_upsert():
+    key = {'login': 'ADMIN', 'elog': 'test.upsert'}
+    DB.param_delete('accounts', key)
+    try:
+        created = DB.upsert('accounts', key, {'login_data': '{"password": "1"}', 'status': False})
+        assert created
+        assert created['login_data'] == {'password': '1'}
+        updated = DB.upsert('accounts', key, {'login_data': '{"password": "2"}', 'status': True})
+        assert updated['account_id'] == created['account_id']
+        assert updated['login_data'] == {'password': '2'}
+        assert updated['status']
+    finally:
+        DB.param_delete('accounts', key)
+
+def plan_nodes(plan):
+    yield plan
+    for subplan in plan.get('Plans', []):
+        yield from plan_nodes(subplan)
+
+def seq_scans(sql, params):
+    """returns relations scanned sequentially by sql even when planner is
+    told to avoid seq scans, ie relations lacking suitable index"""
+    plan = DB.execute('set local enable_seqscan = off; explain (format json) ' + sql, params)
+    return [node['Relation Name'] for node in plan_nodes(plan[0]['Plan'])\
+        if node['Node Type'] == 'Seq Scan']
+
+def test_migrate():
+    migrate(DB)
+    assert not migrate(DB)
+
+def test_migrate_duplicate_accounts():
+    """001 migration merges duplicate accounts before building the unique index"""
+    migrate(DB)
+    with open(os.path.join(os.path.dirname(__file__), '..', 'migrations',\
+        '001_hot_path_indexes.sql'), 'r') as sql_file:
+        sql = sql_file.read()
+    with pytest.raises(ValueError):
+        with DB.transaction() as conn:
+            with conn.cursor() as cur:
+                cur.execute('drop index accounts_login_elog_key')
+                ids = []
+                for data in ('1', '2', '3'):
+                    cur.execute("""insert into accounts (login, elog, login_data)
+                        values ('ADMIN', 'test_dup', %s) returning account_id""", (data,))
+                    ids.append(cur.fetchone()[0])
+                    cur.execute('insert into uploads (account_id) values (%s)', (ids[-1],))
+                cur.execute(sql)
+                cur.execute("""select account_id, login_data from accounts
+                    where login = 'ADMIN' and elog = 'test_dup'""")
+                assert cur.fetchall() == [(ids[-1], 3)]
+                cur.execute('select count(*) from uploads where account_id = %s', (ids[-1],))
+                assert cur.fetchone()[0] == 3
+            raise ValueError()
+
+@pytest.mark.parametrize('sql', [
+    """select upload_id, elog, login_data, state
+        from uploads join accounts on uploads.account_id = accounts.account_id
+        where accounts.login = %(login)s""",
+    """delete from uploads
+        where upload_id = %(upload_id)s and account_id in
+            (select account_id
+            from accounts
+            where login = %(login)s)""",
+    """select upload_id
+        from uploads join accounts on uploads.account_id = accounts.account_id
+        where upload_id = %(upload_id)s and login = %(login)s"""])
+def test_hot_path_plans(sql):
+    migrate(DB)
+    assert not seq_scans(sql, {'login': 'ADMIN', 'upload_id': 1})
+
+def test_prepared_statements():
+    db = DBConn(CONF.items('db'))
+    db.connect()
+    db.prepared_cache_size = 2
+    for _ in range(3):
+        assert db.get_object('users', {'login': 'ADMIN'}, create=False)
+    assert len(db.conn.prepared) == 1
+    assert db.get_object('users', {'login': 'ADMIN', 'email': None}, create=False) is not None
+    assert db.param_update('users', {'login': 'ADMIN'}, {'login': 'ADMIN'})
+    assert len(db.conn.prepared) == 2
+    assert db.execute('select count(*) from pg_prepared_statements') == 2
+    db.conn.close()
+    assert db.get_object('users', {'login': 'ADMIN'}, create=False)
+    assert len(db.conn.prepared) == 1
+
+def test_prepared_statements_errors():
+    db = DBConn(CONF.items('db'))
+    db.connect()
+    db.execute('drop table if exists test_prepared')
+    db.execute('create table test_prepared (id integer primary key, name text)')
+    try:
+        assert db.get_object('test_prepared', {'id': 1, 'name': 'a'}, create=True)
+        assert db.get_object('test_prepared', {'id': 1}, create=False)
+        #failed statement stays prepared and cached
+        assert db.get_object('test_prepared', {'id': 1, 'name': 'b'}, create=True) is False
+        assert db.get_object('test_prepared', {'id': 2, 'name': 'b'}, create=True)
+        assert len(db.conn.prepared) == 2
+        #result type of prepared select * is changed
+        db.execute('alter table test_prepared add column extra integer')
+        row = db.get_object('test_prepared', {'id': 1}, create=False)
+        assert row and 'extra' in row
+        assert db.execute('select count(*) from pg_prepared_statements') == len(db.conn.prepared)
+        db.execute('alter table test_prepared drop column extra')
+        with db.transaction():
+            row = db.get_object('test_prepared', {'id': 1}, create=False)
+        assert row and 'extra' not in row
+    finally:
+        db.execute('drop table if exists test_prepared')
+        db.conn.close()
+
+def test_transaction():
+    logins = ['test_tx_1', 'test_tx_2', 'test_tx_3']
+
+    def stored_logins():
+        return DB.execute("select login from users where login like 'test\\_tx\\_%' order by login",\
+            keys=True) or []
+
+    DB.execute("delete from users where login like 'test\\_tx\\_%'")
+    try:
+        with DB.transaction():
+            DB.get_object('users', {'login': logins[0], 'password': '1'}, create=True)
+            with pytest.raises(Exception):
+                with DB.transaction():
+                    DB.get_object('users', {'login': logins[1], 'password': '1'}, create=True)
+                    DB.get_object('users', {'login': logins[0], 'password': '1'}, create=True)
+            with DB.transaction():
+                DB.get_object('users', {'login': logins[2], 'password': '1'}, create=True)
+        assert stored_logins() == [logins[0], logins[2]]
+        with pytest.raises(ValueError):
+            with DB.transaction():
+                DB.param_delete('users', {'login': logins[0]})
+                raise ValueError()
+        assert stored_logins() == [logins[0], logins[2]]
+    finally:
+        DB.execute("delete from users where login like 'test\\_tx\\_%'")
+
+def test_transaction_single_connection():
+    db = DBConn(CONF.items('db'))
+    db.connect()
+    started = threading.Event()
+
+    def stored_logins():
+        return db.execute("select login from users where login like 'test\\_stx\\_%' order by login",\
+            keys=True) or []
+
+    def transaction():
+        with pytest.raises(ValueError):
+            with db.transaction():
+                db.get_object('users', {'login': 'test_stx_1', 'password': '1'}, create=True)
+                started.set()
+                time.sleep(0.3)
+                raise ValueError()
+
+    db.execute("delete from users where login like 'test\\_stx\\_%'")
+    try:
+        thread = threading.Thread(target=transaction)
+        thread.start()
+        started.wait()
+        #commit of another thread does not commit the transaction
+        assert db.get_object('users', {'login': 'test_stx_2', 'password': '1'}, create=True)
+        thread.join()
+        assert stored_logins() == ['test_stx_2']
+    finally:
+        db.execute("delete from users where login like 'test\\_stx\\_%'")
+        db.conn.close()
+
+def test_query():
+    res = DB.query('select g as id, g * 2 as double from generate_series(1, %(cnt)s) g',\
+        {'cnt': 3})
+    assert len(res) == 3
+    assert res.scalar() == 1
+    assert res.one().double == 2
+    assert [row.id for row in res.all()] == [1, 2, 3]
+    assert res.by_key()[3].double == 6
+    assert type(res.all()[0]) is type(DB.query('select 1 as id, 2 as double').one())
+    empty = DB.query('select 1 as id where false')
+    assert empty.all() == []
+    assert empty.one() is None
+    assert empty.scalar() is None
+
+def test_file_store_registry(tmp_path):
+    migrate(DB)
+    store = FileStore(str(tmp_path), db=DB, max_size=100, grace=0)
+    data = [bytes([ord('a') + idx]) * 60 for idx in range(3)]
+    refs = [store.file_ref(item) for item in data]
+    DB.execute('delete from files where file_hash = any(%(refs)s)', {'refs': refs})
+    try:
+        assert store.put(data[0], {'qso_count': 1}) == refs[0]
+        assert store.stats(refs[0]) == {'qso_count': 1}
+        assert store.stats(refs[1]) is None
+        store.acquire(refs[0])
+        store.put(data[1])
+        #referenced file is kept even if the store is over the limit
+        assert os.path.exists(store.file_path(refs[0]))
+        store.release(refs[0])
+        store.put(data[2])
+        assert [os.path.exists(store.file_path(ref)) for ref in refs] == [False, False, True]
+        assert DB.execute('select count(*) from files where file_hash = any(%(refs)s)',\
+            {'refs': refs}) == 1
+        assert not store.acquire(refs[0])
+        assert store.acquire(refs[2])
+        store.release(refs[2])
+
+        #file is put while other process evicts it: put waits for the eviction
+        #and stores the file again
+        evictor = DBConn(CONF.items('db'))
+        evictor.connect()
+        with evictor.transaction():
+            evictor.execute('delete from files where file_hash = %(ref)s', {'ref': refs[2]})
+            put = threading.Thread(target=store.put, args=(data[2],))
+            put.start()
+            put.join(0.5)
+            assert put.is_alive()
+            os.unlink(store.file_path(refs[2]))
+        put.join(5)
+        assert os.path.exists(store.file_path(refs[2]))
+        assert store.acquire(refs[2])
+        store.release(refs[2])
+    finally:
+        DB.execute('delete from files where file_hash = any(%(refs)s)', {'refs': refs})
@@ -7,11 +7,16 @@ import logging
 import sys
 import base64
 import os
+import threading
+from asyncio import CancelledError
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+import requests
 
 sys.path.append('oneadif')
 from db import DBConn, splice_params
 from conf import CONF
-from elog import ELog
+from elog import ELog, SessionCache, UploadBody, json_parts, Base64Content
 
 DB = DBConn(CONF.items('db'))
 DB.verbose = True
@@ -34,6 +39,22 @@ DATA = {
     }}
 FILE = {'name': FILENAME, 'file': adif}
 
+@pytest.mark.parametrize('value', [',' + base64.b64encode(os.urandom(200000)).decode(),\
+    '<CALL:4>R7CL<COMMENT:6>"Тест\\"<EOR>\n' * 10000])
+def test_upload_body(value):
+    file_entry = {'name': 'test.adi'}
+    parts = json_parts({'files': [file_entry]}, file_entry, 'file', value)
+    progress = []
+    body = UploadBody(parts, progress.append)
+    data = b''.join(bytes(chunk) for chunk in body)
+    assert len(data) == len(body)
+    assert json.loads(data) == {'files': [{'name': 'test.adi', 'file': value}]}
+    assert progress[-1] == 1
+    cancel_event = threading.Event()
+    cancel_event.set()
+    with pytest.raises(CancelledError):
+        list(UploadBody(parts, cancel_event=cancel_event))
+
 def test_upload():
     accounts = DB.execute("select * from accounts where login = %(login)s", {'login': LOGIN}, keys=True)
     for account in accounts:
@@ -43,4 +64,41 @@ def test_upload():
         if elog_type in DATA:
             elog.upload(FILE, DATA[elog_type], upload_callback)
 
+def test_session_cache():
+    cache = SessionCache(ttl=60)
+    accounts = DB.execute("select * from accounts where login = %(login)s", {'login': LOGIN}, keys=True)
+    for account in accounts:
+        key = (account['account_id'], account['elog'])
+        elog = cache.get(key, account['elog'], account['login_data'])
+        assert elog.session
+        assert cache.get(key, account['elog'], account['login_data']) is elog
+        cache.invalidate(key)
+        assert cache.get(key, account['elog'], account['login_data']) is not elog
+
+class StatusHandler(BaseHTTPRequestHandler):
+    """answers upload request with the status code of its path"""
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.send_response(int(self.path[1:]))
+        self.send_header('Content-Length', '0')
+        self.end_headers()
 
+def test_upload_auth_failed(monkeypatch):
+    server = HTTPServer(('127.0.0.1', 0), StatusHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:' + str(server.server_port) + '/'
+    elog = ELog('test')
+    elog.session = requests.Session()
+    monkeypatch.setattr(elog, 'upload_request',\
+        lambda file, params: (url + file['name'], [file['file']]))
+    try:
+        files = [{'name': status, 'file': Base64Content(b'QSO')}\
+            for status in ('200', '500')]
+        assert elog.upload_many(files, {}, max_parts=2) == ([True, False], False)
+        files.append({'name': '401', 'file': Base64Content(b'QSO')})
+        assert elog.upload_many(files, {}, max_parts=2) == ([True, False, False], True)
+        #the flag is not kept by the elog shared by uploads
+        assert elog.upload_many(files[:1], {}) == ([True], False)
+    finally:
+        server.shutdown()
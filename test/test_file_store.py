@@ -0,0 +1,62 @@
+#!/usr/bin/python3
+#coding=utf-8
+
+import pytest
+import base64
+import os
+import sys
+
+sys.path.append('oneadif')
+from file_store import FileStore
+from elog import Base64Content, UploadBody, json_parts
+
+@pytest.fixture
+def store(tmp_path):
+    return FileStore(str(tmp_path / 'store'))
+
+def test_put(store):
+    ref = store.put(b'<EOR>')
+    #store without db keeps no references
+    store.acquire(ref)
+    store.release(ref)
+    assert store.evict() == []
+    assert store.put(b'<EOR>') == ref
+    assert os.listdir(os.path.dirname(store.file_path(ref))) == [ref]
+    stored = store.open(ref)
+    assert stored[:] == b'<EOR>'
+    stored.close()
+    assert store.open(store.put(b'')) == b''
+    with pytest.raises(FileNotFoundError):
+        store.open('0' * 64)
+
+def test_spool_file(store):
+    data = os.urandom(100000)
+    spool = store.spool_file(max_size=len(data))
+    for pos in range(0, len(data), 4096):
+        spool.write(data[pos:pos + 4096])
+    spool.seek(0)
+    assert spool.read() == data
+    spool.close()
+    assert not spool.too_large
+    assert spool.ref == FileStore.file_ref(data)
+    assert store.put_spooled(spool.ref, spool.path) == spool.ref
+    assert store.open(spool.ref)[:] == data
+    spool = store.spool_file(max_size=len(data) - 1)
+    spool.write(data)
+    spool.write(b'<EOR>')
+    spool.close()
+    assert spool.too_large
+    assert os.path.getsize(spool.path) == 0
+    os.unlink(spool.path)
+
+@pytest.mark.parametrize('size', [0, 1, 2, 3, 49152, 49153, 200000])
+def test_base64_content(store, size):
+    data = os.urandom(size)
+    content = Base64Content(store.open(store.put(data)), prefix=',')
+    file_entry = {'name': 'test.adi'}
+    body = UploadBody(json_parts({'files': [file_entry]}, file_entry, 'file', content))
+    encoded = b''.join(bytes(chunk) for chunk in body)
+    assert len(encoded) == len(body)
+    assert encoded == ('{"files": [{"name": "test.adi", "file": ",' +\
+        base64.b64encode(data).decode() + '"}]}').encode()
+    content.close()
@@ -0,0 +1,108 @@
+#!/usr/bin/python3
+#coding=utf-8
+
+import pytest
+import asyncio
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+
+sys.path.append('oneadif')
+from conf import CONF
+import upload_async
+from upload_async import AsyncUploadServer
+from upload_srv import UploadClient
+from test_uploads import BlockingUpload
+
+def run_server(address, tmp_path):
+    CONF.read_dict({'files': {'upload_status': str(tmp_path / 'uploads_status'),\
+        'store': str(tmp_path / 'store')}})
+    os.makedirs(CONF['files']['store'], exist_ok=True)
+    upload_async.serve_forever(address)
+
+def test_protocol(tmp_path):
+    address = str(tmp_path / 'upload_srv.sock')
+    server = multiprocessing.Process(target=run_server, args=(address, tmp_path))
+    server.start()
+    try:
+        for _ in range(100):
+            if os.path.exists(address):
+                break
+            time.sleep(0.1)
+        client = UploadClient(address)
+        assert client.call('test', 1, 'a', {'b': None}) == [1, 'a', {'b': None}]
+        futures = [client.request('test', idx) for idx in range(100)]
+        assert [future.result(10) for future in futures] == [[idx] for idx in range(100)]
+        assert client.call('cancel', -1) == 'Upload not found'
+    finally:
+        os.kill(server.pid, signal.SIGTERM)
+        server.join(10)
+    assert server.exitcode == 0
+
+def test_cancel(monkeypatch):
+    jobs = []
+
+    def create_upload(*args, **kwargs):
+        jobs.append(BlockingUpload(*args, **kwargs))
+        return jobs[-1]
+
+    monkeypatch.setattr(upload_async, 'UploadProcess', create_upload)
+
+    async def run():
+        server = AsyncUploadServer(1, 1)
+        running = await server.submit(None, {}, {})
+        queued = await server.submit(None, {}, {})
+        assert await server.submit(None, {}, {}) is None
+        await asyncio.sleep(0.1)
+        assert jobs[0].states == ['upload']
+
+        #queued upload is cancelled before it runs
+        assert await server.run_command('cancel', [queued]) == 'ok'
+        await asyncio.sleep(0.1)
+        assert jobs[1].states == []
+        assert jobs[1].state == 'cancelled'
+        assert server.cancel(queued) == 'Upload cannot be cancelled'
+
+        assert server.cancel(running) is None
+        await asyncio.sleep(0.1)
+        assert jobs[0].states == ['upload', 'cancelled']
+        assert server.cancel(running) == 'Upload cannot be cancelled'
+        assert server.cancel(-1000000) == 'Upload not found'
+
+        #admission is released by finished uploads;
+        #target which failed does not affect other ones
+        upload_ids = await server.submit_many({}, [[None, {}], [None, {'fail': True}], [None, {}]])
+        assert upload_ids[1] is None
+        assert None not in upload_ids[::2]
+        await asyncio.sleep(0.1)
+        assert jobs[2].states == ['upload']
+        assert jobs[3].states == []
+        for job in jobs[2:]:
+            server.cancel(job.upload_id)
+        await asyncio.sleep(0.1)
+
+    asyncio.run(run())
+
+def test_submit_parsing(monkeypatch):
+    threads = []
+
+    def new_qsos(account_id, file):
+        threads.append(threading.get_ident())
+        return file
+
+    monkeypatch.setattr(upload_async, 'UploadProcess', BlockingUpload)
+    monkeypatch.setattr(upload_async, 'new_qsos', new_qsos)
+
+    async def run():
+        server = AsyncUploadServer(1, 0)
+        upload_id = await server.submit(None, {'ref': 'test'}, {})
+        #file is parsed outside of the event loop thread
+        assert threads and threading.get_ident() not in threads
+        await asyncio.sleep(0.1)
+        server.cancel(upload_id)
+        await asyncio.sleep(0.1)
+
+    asyncio.run(run())
@@ -0,0 +1,150 @@
+#!/usr/bin/python3
+#coding=utf-8
+
+import pytest
+import sys
+import multiprocessing
+
+sys.path.append('oneadif')
+from upload_status import StatusTable, StatusWatcher, SEQ, SLOT_SIZE, open_status_table
+
+@pytest.fixture
+def table(tmp_path):
+    return StatusTable(str(tmp_path / 'uploads_status'), slots=4, create=True)
+
+def test_status_table(table):
+    reader = StatusTable(table.path)
+    slot = table.allocate(17, 'ADMIN')
+    assert reader.find(17)['state'] == 0
+
+    def write_progress():
+        for progress in range(101):
+            table.update(slot, 3, progress)
+
+    writer = multiprocessing.Process(target=write_progress)
+    writer.start()
+    writer.join()
+    status = reader.find(17)
+    assert status['state'] == 3
+    assert status['progress'] == 100
+    assert status['updated'] >= status['start']
+    assert status['login'] == 'ADMIN'
+
+    table.free(slot)
+    assert reader.find(17)['progress'] == 100
+    for upload_id in range(18, 22):
+        table.allocate(upload_id, 'ADMIN')
+    assert reader.find(17) is None
+
+def test_status_table_login(table):
+    watcher = StatusWatcher(StatusTable(table.path), interval=0.01)
+    watcher.start()
+    login = 'АДМИНИСТРАТОРЫ16'
+    slot = table.allocate(1, login)
+    assert table.read(slot)['login'] == login
+    assert [upload['upload_id'] for upload in watcher.wait(login, 0, timeout=1)[1]] == [1]
+    #63 bytes of 34 characters fit in the field
+    slot = table.allocate(2, 'L' + login * 3)
+    assert table.read(slot)['login'] == ('L' + login * 3)[:34]
+
+def test_status_table_full(table):
+    slots = [table.allocate(upload_id, 'ADMIN') for upload_id in range(1, 6)]
+    assert None not in slots[:4]
+    assert slots[4] is None
+    table.free(slots[1])
+    table.free(slots[0])
+    assert table.allocate(5, 'ADMIN') == slots[1]
+
+def test_status_watcher(table):
+    watcher = StatusWatcher(StatusTable(table.path), interval=0.01)
+    watcher.start()
+    slot = table.allocate(17, 'ADMIN')
+    version, uploads = watcher.wait('ADMIN', 0, timeout=1)
+    assert [upload['upload_id'] for upload in uploads] == [17]
+    table.allocate(18, 'ADMIN_')
+    assert watcher.wait('ADMIN', version, timeout=0.1)[1] == []
+    table.update(slot, 5, 100)
+    version, uploads = watcher.wait('ADMIN', version, timeout=1)
+    assert uploads[0]['state'] == 5
+
+def test_status_watcher_bad_slot(table, monkeypatch):
+    reader = StatusTable(table.path)
+    read = reader.read
+
+    def read_slot(slot):
+        if slot == 0:
+            raise UnicodeDecodeError('utf-8', b'', 0, 1, 'broken slot')
+        return read(slot)
+
+    monkeypatch.setattr(reader, 'read', read_slot)
+    watcher = StatusWatcher(reader, interval=0.01)
+    watcher.start()
+    table.allocate(17, 'ADMIN')
+    table.allocate(18, 'ADMIN')
+    version, uploads = watcher.wait('ADMIN', 0, timeout=1)
+    assert [upload['upload_id'] for upload in uploads] == [18]
+    monkeypatch.setattr(watcher, 'table', None)
+    watcher.wait('ADMIN', version, timeout=0.1)
+    assert watcher.is_alive()
+
+def test_status_resumed_upload(table):
+    watcher = StatusWatcher(StatusTable(table.path), interval=0.01)
+    watcher.start()
+    slot = table.allocate(42, 'ADMIN')
+    table.update(slot, 4, 50)
+    table.free(slot)
+    version, uploads = watcher.wait('ADMIN', 0, timeout=1)
+    assert uploads[0]['state'] == 4
+    #resumed upload gets new slot, the old one keeps the failure
+    resumed_slot = table.allocate(42, 'ADMIN')
+    assert resumed_slot != slot
+    table.update(resumed_slot, 3, 10)
+    assert table.find(42)['state'] == 3
+    version, uploads = watcher.wait('ADMIN', version, timeout=1)
+    assert [(upload['upload_id'], upload['state']) for upload in uploads] == [(42, 3)]
+    assert [(upload['upload_id'], upload['state'])\
+        for upload in watcher.wait('ADMIN', 0, timeout=1)[1]] == [(42, 3)]
+
+def test_status_table_dead_writer(table):
+    reader = StatusTable(table.path)
+    slot = table.allocate(17, 'ADMIN')
+    #writer died in the middle of the write
+    with open(table.path, 'r+b') as table_file:
+        table_file.seek(slot * SLOT_SIZE)
+        table_file.write(SEQ.pack(reader.seq(slot) + 1))
+    assert reader.read(slot) is None
+    table.update(slot, 3, 50)
+    assert reader.read(slot)['progress'] == 50
+
+def test_open_status_table(tmp_path):
+    path = str(tmp_path / 'uploads_status')
+    assert open_status_table(path) is None
+    StatusTable(path, slots=4, create=True)
+    assert open_status_table(path).slots == 4
+    assert open_status_table(path) is open_status_table(path)
+    StatusTable(path, slots=8, create=True).allocate(17, 'ADMIN')
+    assert open_status_table(path).slots == 8
+    assert open_status_table(path).find(17)
+
+def test_status_watcher_table_replaced(table):
+    watcher = StatusWatcher(open_status_table(table.path), interval=0.01)
+    watcher.start()
+    table.allocate(17, 'ADMIN')
+    version, _ = watcher.wait('ADMIN', 0, timeout=1)
+    StatusTable(table.path, slots=8, create=True).allocate(18, 'ADMIN')
+    version, uploads = watcher.wait('ADMIN', version, timeout=1)
+    assert [upload['upload_id'] for upload in uploads] == [18]
+
+def test_status_watcher_cursor(table):
+    watchers = [StatusWatcher(StatusTable(table.path), interval=0.01) for _ in range(2)]
+    for watcher in watchers:
+        watcher.start()
+    table.allocate(17, 'ADMIN')
+    version, _ = watchers[0].wait('ADMIN', 0, timeout=1)
+    cursor = watchers[0].cursor(version)
+    assert watchers[0].cursor_version(cursor) == version
+    #cursor of another process gets all uploads of the user at once
+    assert watchers[1].cursor_version(cursor) == 0
+    _, uploads = watchers[1].wait('ADMIN', watchers[1].cursor_version(cursor), timeout=1)
+    assert [upload['upload_id'] for upload in uploads] == [17]
+    assert watchers[1].cursor_version(0) == 0
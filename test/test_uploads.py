@@ -7,12 +7,18 @@ import logging
 import sys
 import base64
 import os
-from multiprocessing.connection import Client
+import time
+import asyncio
+import signal
+import itertools
+import multiprocessing
 
 sys.path.append('oneadif')
 from db import DBConn, splice_params
 from conf import CONF
-from upload_srv import upload_client
+import upload_srv
+from upload_srv import upload_client, UploadPool
+from file_store import FileStore
 
 DB = DBConn(CONF.items('db'))
 DB.verbose = True
@@ -49,18 +55,142 @@ def test_upload():
     for account in upload_data['uploads']:
 
         def create_upload():
-            with upload_client() as conn:
-                conn.send(('upload', (account['account_id'], upload_data['file'], account['params'])))
-                upload_id = conn.recv()
-                logging.debug('upload id: ' + str(upload_id))
-                return upload_id
+            upload_id = upload_client().call('upload', account['account_id'],\
+                upload_data['file'], account['params'])
+            logging.debug('upload id: ' + str(upload_id))
+            return upload_id
 
         upload_id = create_upload()
 
-        with upload_client() as conn:
-            conn.send(('cancel', upload_id))
-            rsp = conn.recv()
-            logging.debug(rsp)
+        rsp = upload_client().call('cancel', upload_id)
+        logging.debug(rsp)
 
         create_upload()
 
+def test_upload_by_ref():
+    upload_data = create_upload_data()
+    file = {'name': upload_data['file']['name']}
+    file['ref'] = FileStore(CONF['files']['store'], db=DB).put(\
+        base64.b64decode(upload_data['file']['file'][1:]))
+    for account in upload_data['uploads']:
+        assert upload_client().call('upload', account['account_id'], file, account['params'])
+
+def test_upload_many():
+    upload_data = create_upload_data()
+    targets = [[account['account_id'], account['params']] for account in upload_data['uploads']]
+    upload_ids = upload_client().call('upload_many', upload_data['file'], targets)
+    assert len(upload_ids) == len(targets)
+    assert all(upload_ids)
+    for upload_id in upload_ids:
+        assert upload_client().call('cancel', upload_id) in ('ok', 'Upload cannot be cancelled')
+
+def test_pipelining():
+    futures = [upload_client().request('test', idx) for idx in range(100)]
+    assert [future.result(10) for future in futures] == [[idx] for idx in range(100)]
+
+def test_resume():
+    upload_data = create_upload_data()
+    account = upload_data['uploads'][0]
+    file = {'name': upload_data['file']['name']}
+    file['ref'] = FileStore(CONF['files']['store'], db=DB).put(\
+        base64.b64decode(upload_data['file']['file'][1:]))
+    upload_id = upload_client().call('upload', account['account_id'], file, account['params'])
+    assert upload_client().call('resume', upload_id) == 'Upload is running'
+    upload_client().call('cancel', upload_id)
+    for _ in range(100):
+        if DB.execute("select state from uploads where upload_id = %(upload_id)s",\
+            {'upload_id': upload_id}) == 'cancelled':
+            break
+        time.sleep(0.1)
+    assert upload_client().call('resume', upload_id) == 'ok'
+    assert upload_client().call('resume', -1) == 'Upload not found'
+
+class BlockingUpload():
+    """upload job of either upload server engine which runs until
+    it is cancelled; job with 'silent' param does not report its start,
+    job with 'fail' param is not created"""
+    ids = itertools.count(1)
+
+    def __init__(self, account_id, file, params, upload_id=None):
+        if params.get('fail'):
+            raise Exception('Upload creation failed')
+        self.upload_id = -next(BlockingUpload.ids)
+        self.status_slot = None
+        self.file = file
+        self.params = params
+        self.state = 'init'
+        self.states = []
+
+    def report_state(self, report, state):
+        self.states.append(state)
+        report(self.upload_id, state)
+
+    def run(self, cancel_event, report, report_part=None):
+        if not self.params.get('silent'):
+            self.report_state(report, 'upload')
+        cancel_event.wait()
+        self.report_state(report, 'cancelled')
+
+    async def run_async(self, report, report_part=None):
+        if not self.params.get('silent'):
+            self.report_state(report, 'upload')
+        try:
+            await asyncio.Event().wait()
+        except asyncio.CancelledError:
+            self.report_state(report, 'cancelled')
+
+def wait_for(condition):
+    for _ in range(100):
+        if condition():
+            return
+        time.sleep(0.1)
+    assert condition()
+
+def upload_workers():
+    return [process for process in multiprocessing.active_children()\
+        if isinstance(process, upload_srv.UploadWorker)]
+
+def test_upload_pool(monkeypatch):
+    monkeypatch.setattr(upload_srv, 'UploadProcess', BlockingUpload)
+    up = {}
+    pool = UploadPool(2, 1, 1, _up=up)
+    try:
+        #idle worker is killed
+        idle = upload_workers()[0]
+        os.kill(idle.pid, signal.SIGKILL)
+        wait_for(lambda: idle not in upload_workers() and len(upload_workers()) == 2)
+
+        upload_ids = [pool.submit(None, {}, {}) for _ in range(4)]
+        assert None not in upload_ids[:3]
+        assert upload_ids[3] is None
+        running, queued = upload_ids[:2], upload_ids[2]
+        #both workers take jobs
+        wait_for(lambda: all(up[upload_id]['state'] == 'upload' for upload_id in running))
+        assert up[running[0]]['connector'] is not up[running[1]]['connector']
+        assert up[queued]['connector'] is None
+
+        #worker running an upload is killed
+        worker = up[running[0]]['connector'].worker
+        os.kill(worker.pid, signal.SIGKILL)
+        wait_for(lambda: up[running[0]]['state'] == 'internal error')
+        #the queued upload is run by the new worker
+        wait_for(lambda: up[queued]['state'] == 'upload')
+        assert up[queued]['connector'].worker is not worker
+
+        #worker is killed after it was sent the job which did not start yet
+        silent = pool.submit(None, {}, {'silent': True})
+        assert silent
+        assert pool.cancel(running[1]) is None
+        wait_for(lambda: up[silent]['connector'] is not None)
+        assert up[silent]['state'] == 'init'
+        os.kill(up[silent]['connector'].worker.pid, signal.SIGKILL)
+        wait_for(lambda: up[silent]['state'] == 'internal error')
+
+        #admissions of failed and cancelled uploads are released;
+        #target which failed does not affect other ones
+        upload_ids = pool.submit_many({}, [[None, {}], [None, {'fail': True}], [None, {}]])
+        assert upload_ids[1] is None
+        assert None not in upload_ids[::2]
+        assert pool.submit(None, {}, {}) is None
+    finally:
+        pool.close()
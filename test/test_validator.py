@@ -0,0 +1,52 @@
+#!/usr/bin/python3
+#coding=utf-8
+
+import pytest
+import sys
+import time
+
+sys.path.append('oneadif')
+from validator import TokenCache, UserCache
+
+def test_token_cache():
+    cache = TokenCache(max_size=2)
+    key = TokenCache.key('secret', 'token')
+    assert TokenCache.key('new secret', 'token') != key
+    assert cache.get(key, 'auth') is None
+    claims = {'login': 'ADMIN', 'type': 'auth'}
+    cache.put(key, 'auth', claims, (True, None))
+    assert cache.get(key, 'auth') == (claims, (True, None))
+    assert cache.get(key, 'passwordRecovery') is None
+    for token in ('token 1', 'token 2'):
+        cache.put(TokenCache.key('secret', token), 'auth', None, (False, 'invalid'))
+    assert cache.get(key, 'auth') is None
+    assert cache.get(TokenCache.key('secret', 'token 2'), 'auth') == (None, (False, 'invalid'))
+
+def test_token_cache_expires():
+    cache = TokenCache()
+    key = TokenCache.key('secret', 'token')
+    cache.put(key, 'auth', {'login': 'ADMIN', 'expires': time.time() - 1}, (True, None))
+    assert cache.get(key, 'auth') is None
+
+def test_user_cache(tmp_path):
+    lookups = []
+
+    def lookup(login):
+        lookups.append(login)
+        return login == 'ADMIN'
+
+    generation_path = str(tmp_path / 'user_cache')
+    cache = UserCache(generation_path=generation_path)
+    assert cache.exists('ADMIN', lookup)
+    assert not cache.exists('NEW_USER', lookup)
+    assert cache.exists('ADMIN', lookup)
+    assert not cache.exists('NEW_USER', lookup)
+    assert lookups == ['ADMIN', 'NEW_USER']
+    #invalidation by another process sharing the generation file
+    UserCache(generation_path=generation_path).invalidate()
+    assert not cache.exists('NEW_USER', lookup)
+    assert lookups == ['ADMIN', 'NEW_USER', 'NEW_USER']
+    #lookup errors are not cached
+    assert not cache.exists('ERROR', lambda login: None)
+    assert not cache.exists('ERROR', lookup)
+    assert lookups[-1] == 'ERROR'